@@ -0,0 +1,325 @@
+import argparse
+import json
+import re
+import sys
+from index import SiteIndex
+
+complement = str.maketrans('ACGTUNacgtun', 'TGCAANtgcaan')
+
+
+def reverse_complement(sequence):
+    return sequence.translate(complement)[::-1]
+
+
+def suffix_array(text):
+    """
+    Sort the suffixes of a text by prefix doubling
+
+    :param text:
+    :return: start positions of the suffixes in lexicographic order
+    """
+
+    n = len(text)
+    # Ranks below n + 2 keep the pair keys apart
+    alphabet = {c: r for r, c in enumerate(sorted(set(text)))}
+    rank = [alphabet[c] for c in text]
+    sa = list(range(n))
+    k = 1
+    while n > 1:
+        keys = [rank[i] * (n + 2) + (rank[i + k] + 1 if i + k < n else 0) for i in range(n)]
+        sa.sort(key=keys.__getitem__)
+        rank = [0] * n
+        for r in range(1, n):
+            rank[sa[r]] = rank[sa[r - 1]] + (keys[sa[r]] != keys[sa[r - 1]])
+        if rank[sa[-1]] == n - 1:
+            break
+        k <<= 1
+    return sa
+
+
+def lcp_array(text, sa):
+    """
+    Kasai's longest common prefix array
+
+    :param text:
+    :param sa: suffix array of the text
+    :return: length of the common prefix of every suffix and the previous one in the suffix array
+    """
+
+    n = len(text)
+    rank = [0] * n
+    for r, i in enumerate(sa):
+        rank[i] = r
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        if rank[i] == 0:
+            h = 0
+            continue
+        j = sa[rank[i] - 1]
+        while i + h < n and j + h < n and text[i + h] == text[j + h]:
+            h += 1
+        lcp[rank[i]] = h
+        if h:
+            h -= 1
+    return lcp
+
+
+class Audit:
+    """
+    Whole-construct verification
+    This class checks a finished sequence, linear or circular, for direct and
+    inverted repeats with a suffix array of the sequence and its reverse
+    complement, and for base stretches, GC-rich windows and sites to avoid
+    with linear scans
+    """
+
+    repeat_len = 20
+    invrep_len = 12
+    stretch_len = 8
+    max_gc = 65
+    gc_window = 200
+
+    def __init__(self, repeat_len=None, invrep_len=None, stretch_len=None, max_gc=None, gc_window=None,
+                 avoid=None, avoid_reverse=False):
+        self.repeat_len = self._default(repeat_len, self.repeat_len)
+        self.invrep_len = self._default(invrep_len, self.invrep_len)
+        self.stretch_len = self._default(stretch_len, self.stretch_len)
+        self.max_gc = self._default(max_gc, self.max_gc)
+        self.gc_window = self._default(gc_window, self.gc_window)
+        self.sites = SiteIndex(avoid, avoid_reverse)
+        self.stretch = re.compile(r'([ACGT])\1{' + str(self.stretch_len - 1) + ',}')
+
+    @staticmethod
+    def _default(value, default):
+        return default if value is None else value
+
+    @classmethod
+    def for_optimizer(cls, draco):
+        """
+        Audit with the constraints of an optimizer
+
+        :param draco:
+        :return:
+        """
+
+        return cls(repeat_len=draco.min_repeat_len if draco.check_repeats else 0,
+                   invrep_len=draco.min_invrep_len if draco.check_invreps else 0,
+                   stretch_len=draco.max_stretch if draco.check_stretch else 0,
+                   max_gc=draco.max_gc, gc_window=draco.gc_window if draco.check_gc else 0,
+                   avoid=draco.avoid, avoid_reverse=draco.avoid_reverse)
+
+    def run(self, sequence, circular=False):
+        """
+        Report every violation of a sequence
+        Positions are 1-based. A circular sequence is extended with its start
+        so that the violations across the origin are found
+
+        :param sequence: DNA or RNA sequence
+        :param circular:
+        :return: violation dictionaries
+        """
+
+        sequence = str(sequence).upper().replace('U', 'T')
+        n = len(sequence)
+        text = sequence
+        if circular and n:
+            extension = max(self.repeat_len, self.invrep_len, self.stretch_len, self.gc_window,
+                            self.sites.max_len) - 1
+            text = sequence + (sequence * (extension // n + 1))[:extension]
+
+        violations = []
+        if self.repeat_len:
+            violations += self._repeats(text, n)
+        if self.invrep_len:
+            violations += self._inverted_repeats(text, n)
+        if self.stretch_len:
+            violations += self._stretches(text, n, circular)
+        if self.gc_window:
+            violations += self._gc(text, n, circular)
+        if self.sites.sites:
+            violations += self._sites(text, n)
+        return violations
+
+    def _repeats(self, text, n):
+        """
+        Find the direct repeats as adjacent suffixes sharing a long prefix,
+        keeping the left-maximal ones
+
+        :param text:
+        :param n: length of the sequence without its circular extension
+        :return:
+        """
+
+        text += '$'
+        sa = suffix_array(text)
+        lcp = lcp_array(text, sa)
+        found = set()
+        for r in range(1, len(sa)):
+            length = lcp[r]
+            if length < self.repeat_len:
+                continue
+            i, j = sorted((sa[r - 1], sa[r]))
+            if i and text[i - 1] == text[j - 1]:
+                continue
+            i, j = sorted((i % n, j % n))
+            if i != j:
+                found.add((i, j, length))
+        return [{'type': 'repeat', 'start': i + 1, 'other': j + 1, 'length': length}
+                for i, j, length in sorted(found)]
+
+    def _inverted_repeats(self, text, n):
+        """
+        Find the inverted repeats as suffixes of the sequence and of its
+        reverse complement sharing a long prefix
+        Every suffix is paired with the nearest suffix of the other strand in
+        both directions of the suffix array, and the pairs extending a longer
+        one to the left are dropped
+
+        :param text:
+        :param n: length of the sequence without its circular extension
+        :return:
+        """
+
+        m = len(text)
+        combined = text + '#' + reverse_complement(text) + '$'
+        sa = suffix_array(combined)
+        lcp = lcp_array(combined, sa)
+        pairs = set()
+        for order in (range(len(sa)), range(len(sa) - 1, -1, -1)):
+            last = [None, None]
+            shared = [0, 0]
+            previous = None
+            for r in order:
+                if previous is not None:
+                    common = lcp[max(r, previous)]
+                    shared = [min(shared[0], common), min(shared[1], common)]
+                previous = r
+                strand = int(sa[r] > m)
+                other = last[1 - strand]
+                if other is not None and shared[1 - strand] >= self.invrep_len:
+                    a, p = (sa[r], other) if strand == 0 else (other, sa[r])
+                    length = shared[1 - strand]
+                    pairs.add((a, m - (p - m - 1) - length, length))
+                last[strand] = sa[r]
+                shared[strand] = m
+        found = set()
+        for a, b, length in pairs:
+            if (a - 1, b, length + 1) in pairs:
+                continue
+            i, j = sorted((a % n, b % n))
+            found.add((i, j, length))
+        return [{'type': 'inverted_repeat', 'start': i + 1, 'other': j + 1, 'length': length}
+                for i, j, length in sorted(found)]
+
+    def _stretches(self, text, n, circular):
+        violations = []
+        for match in self.stretch.finditer(text):
+            start = match.start()
+            if start >= n:
+                break
+            if circular and start == 0 and text[0] == text[n - 1] and len(match.group()) < n:
+                continue
+            violations.append({'type': 'stretch', 'start': start + 1, 'length': len(match.group()),
+                               'base': match.group(1)})
+        return violations
+
+    def _gc(self, text, n, circular):
+        """
+        Find the regions covered by consecutive GC-rich windows
+
+        :param text:
+        :param n: length of the sequence without its circular extension
+        :param circular:
+        :return:
+        """
+
+        window = min(self.gc_window, n)
+        if not window:
+            return []
+        counts = [0]
+        for base in text:
+            counts.append(counts[-1] + (base in 'GCS'))
+        limit = self.max_gc * window
+        starts = range(n) if circular and n > self.gc_window else range(n - window + 1)
+        violations = []
+        region = None
+        for start in starts:
+            gc = counts[start + window] - counts[start]
+            if gc * 100 < limit:
+                region = None
+                continue
+            if region is None:
+                region = {'type': 'gc', 'start': start + 1, 'end': start + window, 'gc': 0}
+                violations.append(region)
+            region['end'] = (start + window - 1) % n + 1
+            region['gc'] = max(region['gc'], round(gc * 100 / window, 1))
+        return violations
+
+    def _sites(self, text, n):
+        violations = []
+        self.sites.reset()
+        for end, length in enumerate(self.sites._walk(text.replace('T', 'U'))):
+            start = end - length + 1
+            if length and start < n:
+                violations.append({'type': 'site', 'start': start + 1, 'site': text[start:end + 1]})
+        return violations
+
+
+def read(path, circular=False):
+    """
+    Read the sequences of a FASTA or GenBank file, or a raw sequence
+    The topology of GenBank records is used unless circular is set
+
+    :param path:
+    :param circular: treat all the sequences as circular
+    :return: name, sequence and topology of every record
+    """
+
+    with open(path) as handle:
+        text = handle.read()
+    start = text.lstrip()[:5]
+    if start.startswith('>') or start == 'LOCUS':
+        from Bio import SeqIO
+        fmt = 'fasta' if start.startswith('>') else 'genbank'
+        for record in SeqIO.parse(path, fmt):
+            topology = record.annotations.get('topology') == 'circular'
+            yield record.id, str(record.seq), circular or topology
+    else:
+        yield path, ''.join(text.split()), circular
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='draco audit', description='Verify finished constructs')
+    parser.add_argument('input', help='FASTA or GenBank file, or a file holding a raw sequence')
+    parser.add_argument('--circular', help='Treat the sequences as circular (GenBank records use their topology)', action='store_true')
+    parser.add_argument('--avoid', action='append', help='Report this fragment (can be specified multiple times, IUPAC codes allowed)', type=str)
+    parser.add_argument('--avoid-reverse', help='Also report the reverse complement of the --avoid fragments', action='store_true')
+    parser.add_argument('--repeat-len', default=20, help='Min length of a reported repeat, 0 to skip', type=int)
+    parser.add_argument('--inv-repeat-len', default=12, help='Min length of a reported inverted repeat, 0 to skip', type=int)
+    parser.add_argument('--stretch-len', default=8, help='Min length of a reported base stretch, 0 to skip', type=int)
+    parser.add_argument('--max-gc', default=65, help='Max allowed GC content', type=int)
+    parser.add_argument('--gc-window', default=200, help='GC calculation window, 0 to skip', type=int)
+    parser.add_argument('--format', default='text', choices=['text', 'json'], help='Output format', type=str)
+    args = parser.parse_args(argv)
+
+    audit = Audit(repeat_len=args.repeat_len, invrep_len=args.inv_repeat_len, stretch_len=args.stretch_len,
+                  max_gc=args.max_gc, gc_window=args.gc_window, avoid=args.avoid, avoid_reverse=args.avoid_reverse)
+    failed = False
+    for name, sequence, circular in read(args.input, args.circular):
+        violations = audit.run(sequence, circular)
+        failed = failed or bool(violations)
+        if args.format == 'json':
+            print(json.dumps({'name': name, 'length': len(sequence), 'circular': circular,
+                              'violations': violations}))
+            continue
+        print('{}\t{} bp\t{}\t{} violations'.format(name, len(sequence), 'circular' if circular else 'linear',
+                                                     len(violations)))
+        for violation in violations:
+            print('\t'.join([name, violation['type']] +
+                            ['{}={}'.format(key, value) for key, value in violation.items() if key != 'type']))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+from audit import Audit
+from tale import TALE
+from draco import Draco, Racers
+from cache import DesignCache
+from index import PoolIndex
+
+_worker = {}
+
+
+def read_targets(path, upstream='', downstream='', avoid=None):
+    """
+    Read TALE targets from a FASTA or a TSV file
+
+    FASTA descriptions and TSV columns may override the upstream, downstream
+    and avoid settings of a target, e.g.
+    >target1 upstream=DTGQLVKIAK avoid=GGTCTC,CGTCTC
+
+    :param path:
+    :param upstream: default upstream protein sequence
+    :param downstream: default downstream protein sequence
+    :param avoid: default fragments to avoid
+    :return: target dictionaries
+    """
+
+    with open(path) as handle:
+        fasta = handle.read(1) == '>'
+
+    if fasta:
+        from Bio import SeqIO
+        for record in SeqIO.parse(path, 'fasta'):
+            fields = dict(item.split('=', 1) for item in record.description.split()[1:] if '=' in item)
+            yield _target(record.id, str(record.seq), fields, upstream, downstream, avoid)
+    else:
+        with open(path, newline='') as handle:
+            for count, fields in enumerate(csv.DictReader(handle, delimiter='\t')):
+                name = fields.get('name') or 'target' + str(count + 1)
+                yield _target(name, fields['sequence'], fields, upstream, downstream, avoid)
+
+
+def _target(name, sequence, fields, upstream, downstream, avoid):
+    """
+    Apply the per-target overrides to the default settings
+
+    :param name:
+    :param sequence:
+    :param fields:
+    :param upstream:
+    :param downstream:
+    :param avoid:
+    :return:
+    """
+
+    return {
+        'name': name,
+        'sequence': sequence.strip(),
+        'upstream': fields.get('upstream') or upstream,
+        'downstream': fields.get('downstream') or downstream,
+        'avoid': fields['avoid'].split(',') if fields.get('avoid') else avoid,
+    }
+
+
+class Checkpoint:
+    """
+    Journal of the finished targets of a batch
+    Every designed target is appended to the file as a JSON line as soon as
+    it is finished, after a header line holding a hash of the settings of
+    the batch. A batch run again with the same checkpoint and settings skips
+    the targets already designed.
+    """
+
+    def __init__(self, path, settings):
+        """
+        :param path:
+        :param settings: JSON-serializable settings of the batch
+        """
+
+        self.path = path
+        self.key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        self.done = {}
+        self.truncated = False
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            self._read()
+        self.handle = open(path, 'a')
+        if not exists:
+            self._write({'settings': self.key})
+        elif self.truncated:
+            self.handle.write('\n')
+
+    def _read(self):
+        with open(self.path) as handle:
+            text = handle.read()
+        self.truncated = not text.endswith('\n')
+        lines = text.splitlines()
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = {}
+        if header.get('settings') != self.key:
+            raise ValueError('Checkpoint {} was written by a batch with other settings'.format(self.path))
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interruption
+                continue
+            self.done[record['index']] = record
+        logging.info("Resuming from %s, %d targets already designed", self.path, len(self.done))
+
+    def _write(self, record):
+        self.handle.write(json.dumps(record) + '\n')
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def add(self, target, dna, seed):
+        """
+        Record a designed target
+
+        :param target:
+        :param dna:
+        :param seed:
+        :return:
+        """
+
+        self._write({'index': target['index'], 'name': target['name'], 'dna': dna, 'seed': seed})
+
+    def close(self):
+        self.handle.close()
+
+
+def target_seed(seed, index):
+    """
+    Seed of a target, derived from the seed of the batch and the position of
+    the target, so that it does not depend on the process it runs in
+
+    :param seed: seed of the batch, None to draw a new seed for every target
+    :param index: position of the target in the batch
+    :return:
+    """
+
+    return None if seed is None else random.Random('{}/{}'.format(seed, index)).randrange(2 ** 32)
+
+
+def audit(draco, rna):
+    """
+    Verify a finished design as a whole, with the constraints of its optimizer
+    Violations that lie entirely in the prepended or appended sequence are
+    left out, as the optimizer does not change them, and so are palindromes,
+    which the optimizer allows
+
+    :param draco: optimizer of the design
+    :param rna: designed sequence, with the prepended and appended sequences
+    :return: violation dictionaries, see Audit.run
+    """
+
+    start, end = len(draco.prepend), len(rna) - len(draco.append)
+    violations = []
+    for violation in Audit.for_optimizer(draco).run(rna):
+        first = violation['start']
+        if violation.get('other') == first:
+            continue
+        if violation['type'] == 'gc':
+            spans = [(first, violation['end'])]
+        elif violation['type'] == 'site':
+            spans = [(first, first + len(violation['site']) - 1)]
+        else:
+            spans = [(first, first + violation['length'] - 1)]
+        if 'other' in violation:
+            spans.append((violation['other'], violation['other'] + violation['length'] - 1))
+        if any(i <= end and j > start for i, j in spans):
+            violations.append(violation)
+    return violations
+
+
+def _initialize(codons, prepend, append, options, cache_size, pool=False):
+    """
+    Keep the settings shared by all targets in the worker process
+
+    :param codons:
+    :param prepend:
+    :param append:
+    :param options: Draco keyword arguments
+    :param cache_size: max size of the design cache, None to disable it
+    :param pool: check the repeats between the targets
+    :return:
+    """
+
+    _worker['cache'] = None if cache_size is None or pool else DesignCache(max_size=cache_size)
+    _worker['pool'] = PoolIndex() if pool else None
+    _worker['codons'] = codons
+    _worker['prepend'] = prepend
+    _worker['append'] = append
+    _worker['options'] = options
+    _worker['racers'] = None
+
+
+def _design(target, jobs=1):
+    """
+    Optimize a single target in the worker process
+    In pool mode the target is checked against the pool and added to it
+
+    :param target:
+    :param jobs: number of processes racing to optimize the target
+    :return: the target, the DNA sequence (empty on failure) and the seed
+    """
+
+    try:
+        pool = _worker['pool']
+        tale = TALE(target['sequence'], upstream=target['upstream'], downstream=target['downstream'])
+        draco = Draco(tale, _worker['codons'], target['avoid'], _worker['prepend'], _worker['append'],
+                      progress=False, pool=pool, **_worker['options'])
+        cache = _worker['cache']
+        key = DesignCache.key(draco)
+        cached = cache.get(key) if cache and target['seed'] is None else None
+        if cached:
+            rna, draco.seed = cached
+            return target, rna.replace('U', 'T'), draco.seed
+        rna = draco.race(jobs, target['seed'], _worker['racers']) if jobs > 1 else draco.random(target['seed'])
+        violations = audit(draco, rna) if rna and not draco.violations else None
+        if violations:
+            logging.warning("Audit of %s found violations: %s", target['name'], violations)
+        if rna and cache and not draco.violations:
+            cache.put(key, rna, draco.seed)
+        if rna and pool is not None:
+            pool.add(rna[len(draco.prepend):len(rna) - len(draco.append)])
+    except Exception as error:
+        logging.error("Failed to optimize %s: %r", target['name'], error)
+        return target, '', None
+    return target, rna.replace('U', 'T'), draco.seed
+
+
+def run(targets, codons, prepend, append, options, jobs=1, cache_size=None, pool=False, seed=None,
+        checkpoint=None):
+    """
+    Optimize many targets on a pool of processes
+    In pool mode all the targets share one k-mer index, so that there are no
+    repeats or inverted repeats between them either. The targets are then
+    optimized one after the other, each one raced on all the processes, and
+    the design cache is not used
+
+    With a seed, every target gets its own seed derived from it, and the
+    designs are the same whatever the number of processes. With a
+    checkpoint, the finished targets are recorded and those recorded by an
+    interrupted run are yielded again without being designed
+
+    :param targets: target dictionaries, see read_targets
+    :param codons:
+    :param prepend:
+    :param append:
+    :param options: Draco keyword arguments
+    :param jobs: number of processes
+    :param cache_size: max size of the design cache, None to disable it
+    :param pool: check the repeats between the targets
+    :param seed: seed of the batch
+    :param checkpoint: path of the checkpoint file
+    :return: the target, the DNA sequence (empty on failure) and the seed,
+             in order of completion
+    """
+
+    settings = (codons, prepend, append, options, cache_size, pool)
+    journal = None
+    if checkpoint:
+        library = options.get('library')
+        journal = Checkpoint(checkpoint, {
+            'codons': [(codon.rna, str(codon.fraction)) for codon in codons.codons.values()],
+            'prepend': prepend, 'append': append, 'pool': pool, 'seed': seed,
+            'options': dict(options, library=library.path if library else None),
+        })
+    targets = [dict(target, index=index, seed=target_seed(seed, index)) for index, target in enumerate(targets)]
+    return _resume(targets, settings, jobs, journal)
+
+
+def _resume(targets, settings, jobs, journal):
+    """
+    Yield the targets recorded in the checkpoint, then optimize the others
+
+    :param targets:
+    :param settings: arguments of _initialize
+    :param jobs: number of processes
+    :param journal: checkpoint, None to optimize all the targets
+    :return:
+    """
+
+    pending = []
+    finished = []
+    for target in targets:
+        record = journal.done.get(target['index']) if journal else None
+        if record and record['name'] == target['name']:
+            finished.append((target, record['dna'], record['seed']))
+        else:
+            pending.append(target)
+    try:
+        for result in finished:
+            yield result
+        for result in _run(pending, finished, settings, jobs):
+            if journal and result[1]:
+                journal.add(*result)
+            yield result
+    finally:
+        if journal:
+            journal.close()
+
+
+def _run(targets, finished, settings, jobs):
+    """
+    Optimize the targets not designed yet
+    In pool mode the targets designed before are added to the pool first,
+    and the same racing processes are used for all the targets
+
+    :param targets:
+    :param finished: the target, the DNA sequence and the seed of the targets designed before
+    :param settings: arguments of _initialize
+    :param jobs: number of processes
+    :return:
+    """
+
+    codons, prepend, append, options, cache_size, pool = settings
+    if pool:
+        _initialize(*settings)
+        for _, dna, _ in finished:
+            _worker['pool'].add(dna[len(prepend):len(dna) - len(append)])
+        if jobs > 1:
+            _worker['racers'] = Racers(jobs, _worker['pool'])
+        try:
+            for target in targets:
+                yield _design(target, jobs)
+        finally:
+            if _worker['racers']:
+                _worker['racers'].close()
+                _worker['racers'] = None
+    elif jobs > 1:
+        with multiprocessing.Pool(jobs, initializer=_initialize, initargs=settings) as pool:
+            for result in pool.imap_unordered(_design, targets):
+                yield result
+    else:
+        _initialize(*settings)
+        for target in targets:
+            yield _design(target)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import importlib.util
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from tale import TALE
+from draco import Draco
+from codon import CodonUsage
+from library import RepeatLibrary
+
+upstream = 'DTGQLVKIAKRGGVTAMEAVHASRNALTGAPLN'
+downstream = 'SIVAQLSRPDPALAALTNDHLVALACLGGRPAM'
+avoid = ['GGTCTC', 'CGTCTC', 'GAAGAC', 'GCTCTTC']
+checks = ['repeats', 'invreps', 'stretch', 'gc', 'avoid']
+
+
+def target(repeats):
+    """
+    Fixed pseudo-random TALE binding sequence of the given length
+
+    :param repeats:
+    :return:
+    """
+
+    generator = random.Random(repeats)
+    return 'T' + ''.join(generator.choice('ACGT') for _ in range(repeats - 1))
+
+
+def optimizer(codons, case):
+    """
+    Build an optimizer for a benchmark case
+
+    :param codons:
+    :param case:
+    :return:
+    """
+
+    tale = TALE(target(case['repeats']), upstream=upstream, downstream=downstream)
+    return Draco(tale, codons, avoid, '', '', progress=False,
+                 min_repeat_len=case['repeat_len'], max_repeat_len=case['repeat_len'],
+                 min_invrep_len=case['inv_repeat_len'], max_invrep_len=case['inv_repeat_len'],
+                 max_handicap=case['handicap'], max_sequence_attempts=case['seq_attempts'])
+
+
+def bench_random(codons, case, seeds):
+    """
+    Time full optimizations, one per seed
+
+    :param codons:
+    :param case:
+    :param seeds:
+    :return: result record and the last successful design
+    """
+
+    wall = 0
+    attempts = 0
+    successes = 0
+    design = None
+    for seed in seeds:
+        draco = optimizer(codons, case)
+        start = time.perf_counter()
+        rna = draco.random(seed)
+        wall += time.perf_counter() - start
+        attempts += draco.attempts
+        if rna:
+            successes += 1
+            design = draco, rna
+
+    tracemalloc.start()
+    optimizer(codons, case).random(seeds[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'benchmark': 'random', 'case': case, 'wall': wall / len(seeds),
+            'attempts_per_success': attempts / successes if successes else None,
+            'successes': successes, 'runs': len(seeds), 'peak_memory': peak}, design
+
+
+def bench_calls(name, case, function, calls):
+    """
+    Time repeated calls of a function
+
+    :param name:
+    :param case:
+    :param function:
+    :param calls:
+    :return: result record
+    """
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    wall = time.perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'benchmark': name, 'case': case, 'wall': wall / calls, 'calls': calls, 'peak_memory': peak}
+
+
+def bench_fragments(case, draco, rna, calls, library=None, candidates=1):
+    """
+    Time fragment generation and checking against a successful design
+    The sequence indices are rebuilt from all the fragments of the design but
+    the last one, which is then regenerated by every sampler and checked
+
+    :param case:
+    :param draco:
+    :param rna:
+    :param calls:
+    :param library: repeat library to time the library draws, see RepeatLibrary
+    :param candidates: batch size to time the batch sampler, if NumPy is installed
+    :return: result records
+    """
+
+    draco._analyse_codons()
+    draco._reset_indices()
+    fragments = draco.fragments
+    sequences = [draco.prepend]
+    start = len(draco.prepend)
+    for fragment in fragments[:-1]:
+        end = start + 3 * len(fragment)
+        sequences.append(rna[start:end])
+        draco._add_fragment(rna[start:end])
+        start = end
+    index = len(fragments) - 1
+    draco.budget.begin()
+    candidate = draco._compute_fragment(fragments[index])
+    draco.budget.rollback()
+
+    def sampler(sample):
+        def call():
+            draco.budget.begin()
+            sample()
+            draco.budget.rollback()
+        return call
+
+    results = [bench_calls('compute_fragment', case, sampler(lambda: draco._compute_fragment(fragments[index])), calls),
+               bench_calls('forward_fragment', case,
+                           sampler(lambda: draco._forward_fragment(fragments[index], sequences[-1])), calls)]
+    if library:
+        # The last fragment is not a repeat module, the last repeat is drawn instead
+        draco.library = library.entries(draco)
+        if draco.library:
+            repeat = max(draco.library)
+            results.append(bench_calls('draw_fragment', case, sampler(lambda: draco._draw_fragment(repeat)), calls))
+        draco.library = {}
+    if candidates > 1 and importlib.util.find_spec('numpy'):
+        from vectorized import CandidateSampler
+        draco.sampler = CandidateSampler(draco, candidates)
+        results.append(bench_calls('batch_fragment', case,
+                                   sampler(lambda: draco._batch_fragment(fragments[index], sequences, index)), calls))
+        draco.sampler = None
+    results.append(bench_calls('check_fragment', case,
+                               lambda: draco._check_fragment(candidate, sequences, index), calls))
+    flags = {'repeats': 'check_repeats', 'invreps': 'check_invreps', 'stretch': 'check_stretch', 'gc': 'check_gc'}
+    saved = {flag: getattr(draco, flag) for flag in flags.values()}
+    saved_avoid = draco.avoid
+    for check in checks:
+        for flag in flags.values():
+            setattr(draco, flag, False)
+        draco.avoid = None
+        if check == 'avoid':
+            draco.avoid = saved_avoid
+        else:
+            setattr(draco, flags[check], True)
+        results.append(bench_calls('check_fragment:' + check, case,
+                                   lambda: draco._check_fragment(candidate, sequences, index), calls))
+    for flag, value in saved.items():
+        setattr(draco, flag, value)
+    draco.avoid = saved_avoid
+    return results
+
+
+def run(args):
+    codons = CodonUsage(CodonUsage.Dmel)
+    seeds = list(range(args.seed, args.seed + args.runs))
+    grid = itertools.product(args.repeats, args.repeat_len, args.inv_repeat_len, args.handicap)
+    with open(args.output, 'w') if args.output else contextlib.nullcontext(sys.stdout) as output, \
+            tempfile.TemporaryDirectory() as directory:
+        library = RepeatLibrary(os.path.join(directory, 'library.json'), args.library_size)
+        for repeats, repeat_len, inv_repeat_len, handicap in grid:
+            case = {'repeats': repeats, 'repeat_len': repeat_len, 'inv_repeat_len': inv_repeat_len,
+                    'handicap': handicap, 'seq_attempts': args.seq_attempts}
+            result, design = bench_random(codons, case, seeds)
+            results = [result]
+            if design:
+                results += bench_fragments(case, design[0], design[1], args.calls, library, args.candidates)
+            for result in results:
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+                output.flush()
+
+
+def compare(base, new):
+    """
+    Print the wall time ratio of the benchmarks found in both result files
+
+    :param base:
+    :param new:
+    :return:
+    """
+
+    def load(path):
+        with open(path) as handle:
+            records = [json.loads(line) for line in handle if line.strip()]
+        return {(r['benchmark'], json.dumps(r['case'], sort_keys=True)): r for r in records}
+
+    base = load(base)
+    new = load(new)
+    print('benchmark\tcase\tbase\tnew\tratio')
+    for key in sorted(set(base) & set(new)):
+        ratio = new[key]['wall'] / base[key]['wall'] if base[key]['wall'] else float('nan')
+        print('{}\t{}\t{:.6g}\t{:.6g}\t{:.3f}'.format(key[0], key[1], base[key]['wall'], new[key]['wall'], ratio))
+
+
+parser = argparse.ArgumentParser(description='Direct Repeat Aware Codon Optimizer benchmarks')
+parser.add_argument('--repeats', nargs='+', default=[10, 18, 26, 34], help='Numbers of TALE repeats', type=int)
+parser.add_argument('--repeat-len', nargs='+', default=[16, 20], help='Max allowed lengths of a repeat', type=int)
+parser.add_argument('--inv-repeat-len', nargs='+', default=[11, 12], help='Max allowed lengths of an inverted repeat', type=int)
+parser.add_argument('--handicap', nargs='+', default=[0, 1], help='Max codon handicaps', type=int)
+parser.add_argument('--seq-attempts', default=200, help='Max attempts to optimize the sequence', type=int)
+parser.add_argument('--runs', default=3, help='Number of optimizations per case, with consecutive seeds', type=int)
+parser.add_argument('--seed', default=1, help='First random seed', type=int)
+parser.add_argument('--calls', default=1000, help='Number of calls per fragment benchmark', type=int)
+parser.add_argument('--library-size', default=100, help='Number of variants per repeat module in the library of the library draw benchmark', type=int)
+parser.add_argument('--candidates', default=32, help='Number of candidates per batch in the batch sampler benchmark (requires NumPy)', type=int)
+parser.add_argument('--output', help='Write the JSON lines results to this file instead of stdout')
+parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='Compare two result files and exit')
+
+if __name__ == '__main__':
+    arguments = parser.parse_args()
+    if arguments.compare:
+        compare(*arguments.compare)
+    else:
+        run(arguments)
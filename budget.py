@@ -0,0 +1,84 @@
+class Budget:
+    """
+    Transactional codon usage budget
+    Every draw decrements the remaining occurrences of a codon and of its
+    residue and is written to a journal. A fragment is drawn in a
+    transaction, which is either rolled back when the fragment is rejected
+    or committed when it is accepted. Committed fragments can still be
+    reverted, last first, when the search backtracks. Both operations cost
+    one step per codon drawn. The journal holds one codon id per occurrence,
+    so that the samplers can record their draws inline.
+    """
+
+    def __init__(self, codons, residues, origins):
+        """
+        :param codons: remaining occurrences by codon id
+        :param residues: remaining occurrences by residue id
+        :param origins: residue id by codon id
+        """
+
+        self.codons = codons
+        self.residues = residues
+        self.origins = origins
+        self.journal = []
+        self.marks = []
+        self.committed = []
+
+    def begin(self):
+        """
+        Start the transaction of a fragment
+
+        :return:
+        """
+
+        self.marks.append(len(self.journal))
+
+    def draw(self, codon, count=1):
+        """
+        Take occurrences of a codon from the budget
+
+        :param codon: codon id
+        :param count:
+        :return:
+        """
+
+        self.codons[codon] -= count
+        self.residues[self.origins[codon]] -= count
+        self.journal.extend([codon] * count)
+
+    def _undo(self, mark):
+        codons = self.codons
+        residues = self.residues
+        origins = self.origins
+        journal = self.journal
+        for codon in journal[mark:]:
+            codons[codon] += 1
+            residues[origins[codon]] += 1
+        del journal[mark:]
+
+    def rollback(self):
+        """
+        Return the draws of the current transaction to the budget
+
+        :return:
+        """
+
+        self._undo(self.marks.pop())
+
+    def commit(self):
+        """
+        Keep the draws of the current transaction
+
+        :return:
+        """
+
+        self.committed.append(self.marks.pop())
+
+    def revert(self):
+        """
+        Return the draws of the last committed transaction to the budget
+
+        :return:
+        """
+
+        self._undo(self.committed.pop())
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class DesignCache:
+    """
+    Persistent cache of validated designs
+    Designs are keyed by a hash of the TALE protein, the codon usage table,
+    all the constraints of the optimizer and the settings and version of the
+    search, so that the seed of a cached design reproduces it
+    """
+
+    max_size = 64 * 1024 * 1024
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path if path is not None else self.default_path()
+        self.max_size = self.max_size if max_size is None else max_size
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS designs ('
+                                'key TEXT PRIMARY KEY, rna TEXT NOT NULL, seed INTEGER, '
+                                'size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self.connection.commit()
+
+    @staticmethod
+    def default_path():
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache, 'draco', 'designs.sqlite')
+
+    @staticmethod
+    def key(draco):
+        """
+        Hash the protein, codon table, constraints and search settings of an
+        optimizer
+
+        :param draco:
+        :return: hex digest
+        """
+
+        constraints = {
+            'protein': str(draco.sequence.protein()),
+            'codons': [(str(codon.rna), str(codon.protein), str(codon.fraction))
+                       for codon in draco.codons.codons.values()],
+            'avoid': sorted(str(word).upper() for word in draco.avoid or []),
+            'avoid_reverse': draco.avoid_reverse,
+            'prepend': str(draco.prepend),
+            'append': str(draco.append),
+            'check_repeats': draco.check_repeats,
+            'min_repeat_len': draco.min_repeat_len,
+            'max_repeat_len': draco.max_repeat_len,
+            'check_invreps': draco.check_invreps,
+            'min_invrep_len': draco.min_invrep_len,
+            'max_invrep_len': draco.max_invrep_len,
+            'check_stretch': draco.check_stretch,
+            'max_stretch': draco.max_stretch,
+            'check_gc': draco.check_gc,
+            'max_gc': draco.max_gc,
+            'gc_window': draco.gc_window,
+            'max_handicap': draco.max_handicap,
+            'handicap_schedule': draco.handicap_schedule,
+            'max_repeat_attempts': draco.max_repeat_attempts,
+            'max_sequence_attempts': draco.max_sequence_attempts,
+            'engine': draco.engine,
+            'backtrack_depth': draco.backtrack_depth,
+            'max_backtracks': draco.max_backtracks,
+            'forward_check': draco.forward_check,
+            'candidates': draco.candidates,
+            'library': DesignCache._library(draco),
+            'version': draco.version,
+        }
+        return hashlib.sha256(json.dumps(constraints, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _library(draco):
+        """
+        Hash the library variants of the repeats of an optimizer
+
+        :param draco:
+        :return: hex digest, None without a library
+        """
+
+        if not draco.library:
+            return None
+        pools = {draco.proteins[index]: variants for index, variants in draco.library.items()}
+        return hashlib.sha256(json.dumps(pools, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a design
+
+        :param key:
+        :return: the RNA sequence and its seed, None if not cached
+        """
+
+        row = self.connection.execute('SELECT rna, seed FROM designs WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute('UPDATE designs SET accessed = ? WHERE key = ?', (time.time(), key))
+        self.connection.commit()
+        return row[0], row[1]
+
+    def put(self, key, rna, seed):
+        """
+        Store a design and evict the least recently used ones beyond the max size
+
+        :param key:
+        :param rna:
+        :param seed:
+        :return:
+        """
+
+        rna = str(rna)
+        self.connection.execute('INSERT OR REPLACE INTO designs VALUES (?, ?, ?, ?, ?)',
+                                (key, rna, seed, len(key) + len(rna), time.time()))
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        """
+        Remove the least recently used designs until the cache fits its max size
+
+        :return:
+        """
+
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM designs').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.connection.execute('SELECT key, size FROM designs ORDER BY accessed').fetchall()
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            self.connection.execute('DELETE FROM designs WHERE key = ?', (key,))
+            total -= size
+
+    def close(self):
+        self.connection.close()
@@ -1,6 +1,17 @@
-from Bio.Alphabet import IUPAC
-from Bio.Data import IUPACData
-from Bio.Seq import Seq
+import csv
+import hashlib
+import io
+import logging
+import os
+import re
+import struct
+
+# Standard genetic code, codons in TCAG order
+bases = 'UCAG'
+amino_acids = 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+genetic_code = {a + b + c: amino_acids[16 * i + 4 * j + k]
+                for i, a in enumerate(bases) for j, b in enumerate(bases) for k, c in enumerate(bases)}
+
 
 class CodonUsage:
     Dmel = """
@@ -25,11 +36,209 @@ GUA V 0.11  6.4 (139476)  GCA A 0.17 12.8 (280181)  GAA E 0.33 21.1 (462468)  GG
 GUG V 0.47 27.8 (609794)  GCG A 0.19 14.0 (307977)  GAG E 0.67 42.5 (933622)  GGG G 0.07  4.7 (102708)
 """
 
-    def __init__(self, string):
+    # Header and record of the compiled tables
+    magic = b'DRCT\x01'
+    record = struct.Struct('<3sc d')
+    tolerance = 0.005
+
+    def __init__(self, string=''):
         self.codons = {}
         self.residues = {}
+        self.ids = {}
+        self.table = []
         self._parse(string)
 
+    @classmethod
+    def load(cls, source='Dmel'):
+        """
+        Load a codon usage table by file or organism name
+        Dmel is built in, other names are looked up in the table directory.
+        Tables are validated and compiled once to a binary file in the user
+        cache directory, which later loads read back
+
+        :param source: path of a Kazusa or CoCoPUTs table, or organism name
+        :return:
+        """
+
+        if source == 'Dmel':
+            return cls(cls.Dmel)
+        path = source if os.path.isfile(source) else cls._find(source)
+        with open(path, 'rb') as handle:
+            data = handle.read()
+        compiled = os.path.join(cls.cache_directory(),
+                                hashlib.sha256(cls.magic + data).hexdigest() + '.bin')
+        if os.path.exists(compiled):
+            try:
+                return cls._load(compiled)
+            except (OSError, ValueError, struct.error) as error:
+                logging.warning("Ignoring corrupt compiled codon table %s: %r", compiled, error)
+        usage = cls()
+        for rna, protein, fraction in cls._read(data.decode()):
+            usage._add(rna, protein, fraction)
+        usage.validate()
+        usage._save(compiled)
+        return usage
+
+    @staticmethod
+    def table_directory():
+        directory = os.environ.get('DRACO_CODON_TABLES')
+        if directory:
+            return directory
+        config = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+        return os.path.join(config, 'draco', 'codons')
+
+    @staticmethod
+    def cache_directory():
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache, 'draco', 'codons')
+
+    @classmethod
+    def _find(cls, name):
+        """
+        Find the table of an organism in the table directory, by file name
+        without extension and ignoring case
+
+        :param name:
+        :return: path
+        """
+
+        directory = cls.table_directory()
+        names = {}
+        if os.path.isdir(directory):
+            for entry in sorted(os.listdir(directory)):
+                if os.path.isfile(os.path.join(directory, entry)):
+                    names.setdefault(os.path.splitext(entry)[0].lower(), os.path.join(directory, entry))
+        if name.lower() not in names:
+            raise ValueError('Unknown codon table {}: not a file, and not Dmel or one of the tables in {} ({})'
+                             .format(name, directory, ', '.join(sorted(names)) or 'none'))
+        return names[name.lower()]
+
+    @classmethod
+    def _read(cls, text):
+        """
+        Parse a Kazusa or CoCoPUTs table
+        Kazusa tables list the codons with or without their residue, fraction
+        and frequency per thousand, but always with their count. CoCoPUTs
+        tables are tab or comma separated, with either one column per codon
+        and a single row of counts, or one row per codon with its count or
+        fraction. Fractions are computed from the counts when they are not
+        given
+
+        :param text:
+        :return: RNA codon, residue and fraction triples
+        """
+
+        lines = [line for line in text.splitlines() if line.strip() and not line.startswith('#')]
+        if lines and ('\t' in lines[0] or ',' in lines[0]):
+            entries = cls._read_cocoputs(lines)
+        else:
+            pattern = re.compile(r'([ACGTU]{3})\s+(?:([A-Z*])\s+([\d.]+)\s+)?[\d.]+\s*\(\s*(\d+)\s*\)')
+            entries = [(codon, protein or None, fraction or None, int(count))
+                       for codon, protein, fraction, count in pattern.findall(text.upper())]
+        triples = []
+        totals = {}
+        for codon, protein, fraction, count in entries:
+            rna = codon.upper().replace('T', 'U')
+            if rna not in genetic_code:
+                raise ValueError('Invalid codon ' + codon)
+            protein = protein or genetic_code[rna]
+            if count is not None:
+                totals[protein] = totals.get(protein, 0) + count
+            triples.append((rna, protein, fraction, count))
+        usage = []
+        for rna, protein, fraction, count in triples:
+            if fraction is None:
+                if count is None:
+                    raise ValueError('No fraction nor count for codon ' + rna)
+                fraction = round(count / totals[protein], 4) if totals[protein] else 0.0
+            usage.append((rna, protein, repr(float(fraction))))
+        return usage
+
+    @staticmethod
+    def _read_cocoputs(lines):
+        dialect = '\t' if '\t' in lines[0] else ','
+        rows = list(csv.reader(io.StringIO('\n'.join(lines)), delimiter=dialect))
+        header = [column.strip().upper().replace('U', 'T') if len(column.strip()) == 3 else column.strip().lower()
+                  for column in rows[0]]
+        codons = [column for column in header if column.replace('T', 'U') in genetic_code]
+        if len(codons) == 64:
+            if len(rows) != 2:
+                raise ValueError('Expected a single row of codon counts, found {}'.format(len(rows) - 1))
+            values = dict(zip(header, rows[1]))
+            table = values.get('translation table', '1').strip()
+            if table not in ('', '1'):
+                logging.warning("Reading a table for translation table %s with the standard genetic code", table)
+            return [(codon, None, None, int(float(values[codon]))) for codon in codons]
+        if 'codon' not in header:
+            raise ValueError('Unrecognized codon usage table: no codon columns')
+        entries = []
+        for row in rows[1:]:
+            values = dict(zip(header, row))
+            count = values.get('count') or values.get('number')
+            protein = values.get('aa') or values.get('amino acid') or values.get('residue')
+            entries.append((values['codon'].strip(), protein.strip().upper()[:1] if protein else None,
+                            values.get('fraction') or None, int(float(count)) if count else None))
+        return entries
+
+    def validate(self):
+        """
+        Check that the table has every codon once, with a fraction between 0
+        and 1, and that the fractions of every residue sum to 1 up to rounding
+
+        :return:
+        """
+
+        missing = sorted(set(genetic_code) - set(self.codons))
+        if missing:
+            raise ValueError('Codon usage table is missing ' + ', '.join(missing))
+        if len(self.table) != len(self.codons):
+            raise ValueError('Codon usage table lists some codons more than once')
+        for residue, codons in self.residues.items():
+            fractions = [float(codon.fraction) for codon in codons]
+            if any(fraction < 0 or fraction > 1 for fraction in fractions):
+                raise ValueError('Fractions of {} are not between 0 and 1'.format(residue))
+            if abs(sum(fractions) - 1) > self.tolerance * len(fractions):
+                raise ValueError('Fractions of {} sum to {:.3f} instead of 1'.format(residue, sum(fractions)))
+
+    def _save(self, path):
+        """
+        Write the compiled table atomically
+
+        :param path:
+        :return:
+        """
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'wb') as output:
+            output.write(self.magic + bytes([len(self.table)]))
+            for rna in self.table:
+                codon = self.codons[rna.decode()]
+                output.write(self.record.pack(rna, codon.protein.encode(), float(codon.fraction)))
+        os.replace(temporary, path)
+
+    @classmethod
+    def _load(cls, path):
+        """
+        Read a compiled table: the codons in id order, each with its residue
+        and fraction
+
+        :param path:
+        :return:
+        """
+
+        with open(path, 'rb') as handle:
+            data = handle.read()
+        if not data.startswith(cls.magic):
+            raise ValueError('Not a compiled codon table')
+        count = data[len(cls.magic)]
+        usage = cls()
+        for rna, protein, fraction in cls.record.iter_unpack(data[len(cls.magic) + 1:][:count * cls.record.size]):
+            usage._add(rna.decode(), protein.decode(), repr(fraction))
+        if len(usage.table) != count:
+            raise ValueError('Truncated compiled codon table')
+        return usage
+
     def __getitem__(self, key):
         if key in self.codons.keys():
             return self.codons.get(key)
@@ -60,24 +269,33 @@ GUG V 0.47 27.8 (609794)  GCG A 0.19 14.0 (307977)  GAG E 0.67 42.5 (933622)  GG
             definitions = line.split(')  ')
             for definition in definitions:
                 if definition.strip():
-                    codon = Codon(definition)
-                    self.codons[codon.rna] = codon
-                    if codon.protein not in self.residues.keys():
-                        self.residues[codon.protein] = []
-                    self.residues[codon.protein].append(codon)
+                    self._index(Codon(definition))
+
+    def _add(self, rna, protein, fraction):
+        self._index(Codon(rna, protein, fraction))
+
+    def _index(self, codon):
+        codon.id = len(self.table)
+        self.ids[codon.rna] = codon.id
+        self.table.append(codon.rna.encode())
+        self.codons[codon.rna] = codon
+        if codon.protein not in self.residues.keys():
+            self.residues[codon.protein] = []
+        self.residues[codon.protein].append(codon)
 
 
 class Codon:
     def __init__(self, string, protein=None, fraction=None, frequency=None):
+        self.id = None
         if protein is None:
             parsed = string.split()
-            self.rna = Seq(parsed[0], alphabet=IUPAC.ambiguous_rna)
-            self.protein = Seq(parsed[1], alphabet=IUPAC.protein)
+            self.rna = parsed[0]
+            self.protein = parsed[1]
             self.fraction = parsed[2]
             self.frequency = parsed[3]
         else:
-            self.rna = Seq(string, alphabet=IUPAC.ambiguous_rna)
-            self.protein = Seq(protein, alphabet=IUPAC.protein)
+            self.rna = str(string)
+            self.protein = str(protein)
             self.fraction = fraction
             self.frequency = frequency
 
@@ -1,11 +1,21 @@
 import random
 import re
 import logging
-from Bio.Alphabet import IUPAC
-from Bio.Data import IUPACData
-from Bio.Seq import Seq
-from Bio.SeqUtils import GC
-from progress.bar import Bar
+import multiprocessing
+import time
+from collections import Counter
+from contextlib import nullcontext
+from functools import partial
+from budget import Budget
+from index import KmerIndex, GCIndex, SiteIndex
+from library import RepeatLibrary
+from stats import Stats
+
+# IUPAC protein letters, as in Bio.Data.IUPACData
+protein_letters = 'ACDEFGHIKLMNPQRSTVWY'
+
+_shared = {}
+
 
 class Draco:
     """
@@ -23,6 +33,18 @@ class Draco:
     max_repeat_attempts = 100
     max_sequence_attempts = 1000
     max_handicap = 1
+    engine = 'restart'
+    backtrack_depth = 2
+    max_backtracks = 3
+    forward_check = True
+    time_budget = None
+    timeout = None
+    handicap_schedule = 'adaptive'
+    relax_attempts = 20
+    relax_reserve = 0.1
+    candidates = 1
+    # Raised whenever the design found for a seed changes, see DesignCache.key
+    version = 3
 
     def __init__(self, sequence, codons, avoid, prepend, append,
                  check_repeats=True, min_repeat_len=None, max_repeat_len=None,
@@ -30,13 +52,17 @@ class Draco:
                  check_stretch=True, max_stretch=None,
                  check_gc=True, max_gc=None, gc_window=None,
                  max_repeat_attempts=None, max_sequence_attempts=None,
-                 max_handicap=None, progress=True):
+                 max_handicap=None, progress=True, avoid_reverse=False,
+                 engine=None, backtrack_depth=None, max_backtracks=None, stats=False, library=None,
+                 forward_check=None, time_budget=None, handicap_schedule=None, pool=None, candidates=None,
+                 seed=None, timeout=None):
 
         self.sequence = sequence
         self.codons = codons
         self.avoid = avoid
-        self.prepend = Seq(prepend, alphabet=IUPAC.ambiguous_dna).transcribe()
-        self.append = Seq(append, alphabet=IUPAC.ambiguous_dna).transcribe()
+        self.avoid_reverse = avoid_reverse
+        self.prepend = self._transcribe(prepend)
+        self.append = self._transcribe(append)
         self.check_repeats = check_repeats
         self.check_invreps = check_invreps
         self.check_stretch = check_stretch
@@ -46,229 +72,355 @@ class Draco:
         self.min_invrep_len = self._default(min_invrep_len, self.min_invrep_len)
         self.max_invrep_len = self._default(max_invrep_len, self.max_invrep_len)
         self.max_stretch = self._default(max_stretch, self.max_stretch)
+        self.stretch = re.compile(r'(\w)\1{' + str(self.max_stretch - 1) + ',}')
         self.max_gc = self._default(max_gc, self.max_gc)
         self.gc_window = self._default(gc_window, self.gc_window)
         self.max_repeat_attempts = self._default(max_repeat_attempts, self.max_repeat_attempts)
         self.max_sequence_attempts = self._default(max_sequence_attempts, self.max_sequence_attempts)
         self.max_handicap = self._default(max_handicap, self.max_handicap)
+        self.engine = self._default(engine, self.engine)
+        self.backtrack_depth = self._default(backtrack_depth, self.backtrack_depth)
+        self.max_backtracks = self._default(max_backtracks, self.max_backtracks)
+        self.forward_check = self._default(forward_check, self.forward_check)
+        self.time_budget = self._default(time_budget, self.time_budget)
+        self.timeout = self._default(timeout, self.timeout)
+        self.handicap_schedule = self._default(handicap_schedule, self.handicap_schedule)
+        self.pool = pool
+        self.candidates = self._default(candidates, self.candidates)
+        self.sampler = None
+        self.deadline = None
+        self.relax_deadline = None
+        self.partial = None
+        self.violations = None
         self.progress = progress
         self.bar = None
-        self.residues = {}
-        self.variants = {}
-        self.max_ocr = {}
-        self.repeat_ocr = {}
-        self.thresholds = {}
+        self.alphabet = {}
+        self.proteins = []
+        self.fragments = []
+        self.residues = []
+        self.variants = []
+        self.max_ocr = []
+        self.repeat_ocr = []
+        self.origins = []
+        self.budget = None
+        self.repeat_index = None
+        self.invrep_index = None
+        self.gc_index = None
+        self.avoid_index = SiteIndex(avoid, avoid_reverse)
+        self.rollbacks = 0
+        self.attempts = 0
+        self.seed = seed
+        self.streams = {}
+        self.stream = random.Random(seed)
+        self.stats = Stats() if stats else None
+        self._encode()
+        self.residue_handicaps = [0] * len(self.variants)
+        self.library = library.entries(self) if library else {}
+        self.library_counts = {}
+        self.stretch_steps = {}
+        self.avoid_steps = {}
 
     @staticmethod
     def _default(value, default):
         return default if value is None else value
 
-    def _min_max_len(self, min_length, max_length, inverse):
-        if inverse:
-            min_length = self._default(min_length, self.min_invrep_len)
-            max_length = self._default(max_length, self.max_invrep_len)
-        else:
-            min_length = self._default(min_length, self.min_repeat_len)
-            max_length = self._default(max_length, self.max_repeat_len)
+    @staticmethod
+    def _transcribe(dna):
+        return str(dna or '').replace('T', 'U').replace('t', 'u')
 
-        return min_length, max_length
+    def _encode(self):
+        """
+        Encode the fragments of the sequence as lists of residue ids
+        Residues are numbered in order of appearance, and each one maps to the
+        ids of its codons in the codon usage table
+
+        :return:
+        """
+        fragments = []
+        if self.sequence.upstream:
+            fragments.append(self.sequence.upstream)
+        fragments += [r.sequence() for r in self.sequence.repeats]
+        if self.sequence.downstream:
+            fragments.append(self.sequence.downstream)
+
+        self.alphabet = {}
+        self.variants = []
+        self.origins = [None] * len(self.codons.table)
+        self.proteins = [str(fragment) for fragment in fragments]
+        self.fragments = []
+        for fragment in fragments:
+            encoded = []
+            for r in fragment:
+                if r not in protein_letters:
+                    continue
+                if r not in self.alphabet:
+                    self.alphabet[r] = len(self.variants)
+                    self.variants.append(tuple(codon.id for codon in self.codons[r]))
+                    for codon in self.codons[r]:
+                        self.origins[codon.id] = self.alphabet[r]
+                encoded.append(self.alphabet[r])
+            self.fragments.append(tuple(encoded))
 
     def _analyse_codons(self, handicap=0):
         """
         Analyze codon distribution for the repeat sequence
+        Every residue gets the larger of the uniform handicap and its own
 
         :param handicap:
         :return:
         """
-        self.residues = {}
-        self.variants = {}
-        self.max_ocr = {}
-        self.repeat_ocr = {}
-        self.thresholds = {}
-        sequence = self.sequence.sequence()
         n_repeats = len(self.sequence.repeats)
-        for r in sequence:
-            if r not in IUPACData.protein_letters:
-                continue
-            if r not in self.residues.keys():
-                self.residues[r] = 0
-                self.variants[r] = len(self.codons[r])
-            self.residues[r] = self.residues[r] + 1
-
-        for r in self.residues.keys():
-            self.max_ocr[r] = {}
-            self.repeat_ocr[r] = {}
-            for codon in self.codons[r]:
-                self.max_ocr[r][codon.rna] = round(float(codon.fraction) * self.residues[r]) + handicap
-                self.repeat_ocr[r][codon.rna] = self.max_ocr[r][codon.rna] / n_repeats
-
-    def random(self):
+        self.residues = [0] * len(self.variants)
+        for fragment in self.fragments:
+            for r in fragment:
+                self.residues[r] += 1
+
+        self.max_ocr = [0] * len(self.codons.table)
+        self.repeat_ocr = [0] * len(self.codons.table)
+        for r, residue in enumerate(self.alphabet):
+            for codon in self.codons[residue]:
+                self.max_ocr[codon.id] = round(float(codon.fraction) * self.residues[r]) + \
+                    max(handicap, self.residue_handicaps[r])
+                self.repeat_ocr[codon.id] = self.max_ocr[codon.id] / n_repeats
+        self.budget = Budget(self.max_ocr, self.residues, self.origins)
+
+    def random(self, seed=None, offset=0, stride=1, ceiling=None):
         """
         Use guided random to create codon-optimized sequence
 
+        With a time budget, the attempt that got the furthest is relaxed and
+        returned at the deadline (or when the attempts run out) and its
+        violations are reported in self.violations. The search stops early
+        enough to leave a share of the budget for relaxing. With a timeout,
+        the search gives up at the deadline without a sequence, unless there
+        is a time budget
+
+        The handicap is raised for all the residues on a fixed schedule. The
+        adaptive schedule also raises it, within an attempt, for the residues
+        whose budget runs out where a fragment cannot be optimized
+
+        Every attempt draws from its own random streams, derived from the seed
+        and the attempt number, so that a process running every stride-th
+        attempt finds the same sequences as a single process would
+
+        :param seed: random seed, the seed of the optimizer or a new one if not given
+        :param offset: number of attempts before the first one of this process
+        :param stride: step between the attempts of this process
+        :param ceiling: shared lowest successful attempt of the racing processes,
+            the attempts above it are not run
         :return: string RNA sequence
         """
-        count = 1
-        handicap = 0
+        count = offset + 1
+        handicap = self._handicap(count)
+        self.rollbacks = 0
+        self.partial = None
+        self.violations = None
+        limits = [limit for limit in (self.time_budget, self.timeout) if limit is not None]
+        self.relax_deadline = self.deadline = time.perf_counter() + min(limits) if limits else None
+        if self.time_budget is not None:
+            self.deadline -= self.relax_reserve * min(limits)
+        seed = self.seed if seed is None else seed
+        self.seed = random.SystemRandom().randrange(2 ** 32) if seed is None else seed
+        logging.info("Using seed %d", self.seed)
+        if self.candidates > 1:
+            from vectorized import CandidateSampler
+            self.sampler = CandidateSampler(self, self.candidates)
         if self.progress:
+            from progress.bar import Bar
             self.bar = Bar()
         while True:
+            if ceiling is not None and count > ceiling.value:
+                return ""
+            self.attempts = count
+            if self.stats:
+                self.stats.attempts = count
             if self.progress:
                 self.bar.index = 0
                 self.bar.message = 'Computing sequence [' + str(count) + '/' + str(self.max_sequence_attempts) + ']'
             logging.debug("Computing sequence: " + str(count) + " attempt...")
+            start = time.perf_counter()
+            self.residue_handicaps = [0] * len(self.variants)
             self._analyse_codons(handicap)
+            if self.stats:
+                self.stats.time('analyse_codons', start)
+                start = time.perf_counter()
             sequence = self._compute_sequence()
+            if self.stats:
+                self.stats.time('compute_sequence', start)
+                self.stats.rollbacks = self.rollbacks
             if sequence is not False:
                 logging.debug("Success!")
+                if self.engine == 'backtrack':
+                    logging.info("Rolled back %d fragments in total", self.rollbacks)
                 break
-            count += 1
-            if count % (self.max_sequence_attempts / (self.max_handicap + 1)) == 0:
-                handicap += 1
-                logging.info("Increasing handicap to", handicap)
-            if count == self.max_sequence_attempts:
+            if self._expired() and self.time_budget is None:
+                logging.error("Timed out after %d attempts", count)
+                return ""
+            if self._expired():
+                logging.warning("Time budget exhausted after %d attempts", count)
+                return self._relaxed()
+            count += stride
+            if self._handicap(count) > handicap:
+                handicap = self._handicap(count)
+                logging.info("Increasing handicap to %d", handicap)
+                if self.stats:
+                    self.stats.handicap(count, handicap)
+            if count >= self.max_sequence_attempts:
+                if self.partial:
+                    return self._relaxed()
                 logging.error("Failed to find a suitable sequence! Try increasing the number of attempts,"
                               " the handicap or max repeat length")
                 return ""
         return sequence
 
-    def _get_repeat_words(self, repeat_a, repeat_b, min_length=None, max_length=None, inverse=False):
+    def _handicap(self, count):
         """
-        Retrieve words from a pair of consecutive repeats
+        Uniform handicap of an attempt, raised at every multiple of the
+        handicap period after the first attempt
 
-        :param repeat_a:
-        :param repeat_b:
-        :param min_length:
-        :param max_length:
-        :param inverse:
+        :param count: attempt
         :return:
         """
 
-        min_length, max_length = self._min_max_len(min_length, max_length, inverse)
-        sequence = repeat_a + repeat_b
-        end = len(sequence)
-        for length in range(max_length, min_length - 1, -1):
-            start = 0 if len(repeat_a) - length < 0 else len(repeat_a) - length
-            for pos in range(start, end - min_length):
-                word = sequence[pos:(pos + length)]
-                if inverse:
-                    yield word.reverse_complement()
-                else:
-                    yield word
+        period = self.max_sequence_attempts / (self.max_handicap + 1)
+        return sum(1 for attempt in range(2, count + 1) if attempt % period == 0)
 
-    def _get_words(self, sequence, min_length=None, max_length=None, inverse=False):
+    def _find_bottlenecks(self, sequence):
         """
-        Retrieve words from a generic sequence
+        Find the residues of a fragment that could not be optimized whose
+        budget is left with at most one of their codons
 
-        :param sequence:
-        :param min_length:
-        :param max_length:
-        :param inverse:
-        :return:
+        :param sequence: encoded residues
+        :return: residue ids
         """
 
-        min_length, max_length = self._min_max_len(min_length, max_length, inverse)
-        end = len(sequence)
-        for start in range(0, end - min_length):
-            for length in range(max_length, min_length - 1, -1):
-                word = sequence[start:(start + length)]
-                if inverse:
-                    yield word.reverse_complement()
-                else:
-                    yield word
+        max_ocr = self.max_ocr
+        return [r for r in sorted(set(sequence))
+                if len(self.variants[r]) > 1 and sum(1 for codon in self.variants[r] if max_ocr[codon] > 0) <= 1]
 
-    def _find_repeats(self, sequence, min_length=None, max_length=None, words=None, inverse=False):
+    def _relax_bottlenecks(self, sequence):
         """
-        Find direct repeats in a sequence
+        Raise the handicap of the bottleneck residues of a fragment for the
+        rest of the attempt, giving one more occurrence to each of their codons
+        The handicaps only depend on the attempt itself, so that an attempt
+        finds the same sequence in whichever process it runs
 
-        :param sequence:
-        :param min_length:
-        :param max_length:
-        :param words:
-        :return:
+        :param sequence: encoded residues
+        :return: True if a handicap was raised
         """
 
-        min_length, max_length = self._min_max_len(min_length, max_length, inverse)
-        repeats = {}
-        dups = {}
-        if words is None:
-            words = self._get_words(sequence, min_length, max_length, inverse)
-        for word in words:
-            self._find_all(sequence, word, start=0, repeats=repeats, duplicates=dups)
-        return repeats
-
-    @staticmethod
-    def _find_all(sequence, word, start=0, end=0, repeats=None, duplicates=None):
+        handicap = self._handicap(self.attempts)
+        residues = list(self.alphabet)
+        raised = False
+        for r in self._find_bottlenecks(sequence):
+            level = max(handicap, self.residue_handicaps[r])
+            if level >= self.max_handicap:
+                continue
+            self.residue_handicaps[r] = level + 1
+            for codon in self.variants[r]:
+                self.max_ocr[codon] += 1
+            raised = True
+            logging.debug("Increasing handicap of %s to %d", residues[r], level + 1)
+            if self.stats:
+                self.stats.handicap(self.attempts, level + 1, residues[r])
+        return raised
+
+    def race(self, jobs, seed=None, racers=None):
         """
-        Find all occurrences of a word in sequence
+        Race the attempts of a seed on a pool of processes
 
-        :param sequence:
-        :param word:
-        :param start:
-        :param end:
-        :param repeats:
-        :param duplicates:
-        :return:
-        """
-        start = start + 1
-        end = len(sequence) if end == 0 else end
-        repeats = {} if repeats is None else repeats
-        duplicates = {} if duplicates is None else duplicates
-        length = len(word)
-        matches = []
-        count = 0
-        while True:
-            start = sequence.find(word, start, end)
-            if start == -1:
-                break
-            matches.append(start)
-            start += length
-        if len(matches) > 1:
-            curr = tuple(matches)
-            prev = tuple([x - 1 for x in matches])
-            if curr not in duplicates.keys() and prev not in duplicates.keys():
-                repeats[curr] = word
-                count += 1
-            duplicates[curr] = length
-        return count
+        Process j runs the attempts j + 1, j + 1 + jobs, ... and the sequence
+        of the lowest successful attempt is returned, which is the sequence a
+        single process would find. A process stops as soon as another one has
+        succeeded at a lower attempt.
 
-    def _check_fragment(self, rna, sequences, index):
+        With a time budget, the best relaxed sequence of all the processes is
+        returned if none of them succeeds
+
+        :param jobs: number of processes
+        :param seed: random seed, the seed of the optimizer or a new one if not given
+        :param racers: processes to reuse, see Racers, new ones are started if not given
+        :return: string RNA sequence of the lowest successful attempt
+        """
+        seed = self.seed if seed is None else seed
+        seed = random.SystemRandom().randrange(2 ** 32) if seed is None else seed
+        progress = self.progress
+        pool = self.pool
+        # The racing processes hold their own copy of the pool index
+        self.progress = False
+        self.pool = None
+        found = None
+        best = None
+        try:
+            with (Racers(jobs, pool) if racers is None else nullcontext(racers)) as racers:
+                for attempt, sequence, stats, violations in racers.race(self, seed):
+                    if sequence and not violations:
+                        if found is None or attempt < found[0]:
+                            found = attempt, sequence, stats
+                    elif sequence and (best is None or self._score(violations) < self._score(best[3])):
+                        best = attempt, sequence, stats, violations
+        finally:
+            self.progress = progress
+            self.pool = pool
+        self.seed = seed
+        if found:
+            self.attempts, sequence, self.stats = found
+            self.violations = None
+            logging.info("Found sequence at attempt %d", self.attempts)
+            return sequence
+        if best:
+            self.attempts, sequence, self.stats, self.violations = best
+            logging.info("Using the best relaxed sequence, from attempt %d", self.attempts)
+            return sequence
+        logging.error("Failed to find a suitable sequence in any of the %d processes", jobs)
+        return ""
+
+    def _check_fragment(self, rna, sequences, index, fixed=False, prechecked=False, screened=False):
+        """
+        Check if sequence has repeats, inverted repeats, base stretches,
+        GC-rich windows or sites to avoid
+        Avoided sites inside a fixed fragment are allowed. A prechecked
+        fragment from the repeat library is only checked for stretches and
+        sites across its junction, and a screened candidate of a batch is not
+        checked for stretches and GC content again. The checks stop at the
+        first violation, unless statistics are collected
         """
-        Check if sequence has repeats
+        checks = self._checks(rna, sequences, fixed, prechecked, screened)
+        if self.stats:
+            return self.stats.check(checks, index)
+        return all(check(*arguments) for _, check, arguments in checks)
+
+    def _checks(self, rna, sequences, fixed=False, prechecked=False, screened=False):
         """
-        repeats = []
-        inv_repeats = []
-        stretches = []
-        gc = 0
+        Enabled checks of a fragment, see _check_fragment
 
-        seq = sequences[index - 1] + rna
+        :return: (constraint, function, arguments) tuples
+        """
 
+        checks = []
         if self.check_repeats:
-            words = self._get_repeat_words(sequences[index - 1], rna)
-            repeats = self._find_repeats(sum(sequences, Seq('', IUPAC.ambiguous_rna)) + rna, words=words)
+            checks.append(('repeats', self.repeat_index.check, (rna,)))
         if self.check_invreps:
-            inv_words = self._get_repeat_words(sequences[index - 1], rna, inverse=True)
-            inv_repeats = self._find_repeats(sum(sequences, Seq('', IUPAC.ambiguous_rna)) + rna,
-                                             words=inv_words, inverse=True)
-        if self.check_stretch:
-            stretches = re.findall(r'((\w)\2{' + str(self.max_stretch - 1) + ',})', str(seq))
-        if self.check_gc:
-            end = len(seq) - self.gc_window if len(seq) > self.gc_window else 1
-            for start in range(0, end):
-                cur_gc = GC(seq[start:start+self.gc_window])
-                gc = cur_gc if cur_gc > gc else gc
-                if gc > self.max_gc:
-                    break
-
-        forbidden = False
+            checks.append(('invreps', self.invrep_index.check, (rna,)))
+        if self.check_stretch and not screened:
+            checks.append(('stretch', self._check_stretch, (rna[:self.max_stretch] if prechecked else rna, sequences)))
+        if self.check_gc and not screened:
+            checks.append(('gc', self.gc_index.check, (rna,)))
         if self.avoid:
-            for word in self.avoid:
-                forbidden = (seq.find(word) != -1)
-                if forbidden:
-                    break
+            checks.append(('avoid', self.avoid_index.check, (rna, fixed or prechecked)))
+        return checks
 
-        return len(repeats) == 0 and len(inv_repeats) == 0 and len(stretches) == 0 \
-            and gc < self.max_gc and (not forbidden)
+    def _check_stretch(self, rna, sequences):
+        """
+        Check for base stretches in the fragment and across its junction
+        with the previous fragment
+
+        :param rna:
+        :param sequences: accepted fragments
+        :return: True if there are no stretches
+        """
+
+        return self.stretch.search(sequences[-1][-self.max_stretch:] + rna) is None
 
     def _compute_sequence(self):
         """
@@ -277,78 +429,581 @@ class Draco:
         :return:
         """
 
-        fragments = []
-        if self.sequence.upstream:
-            fragments.append(self.sequence.upstream)
-        fragments += [r.sequence() for r in self.sequence.repeats]
-        if self.sequence.downstream:
-            fragments.append(self.sequence.downstream)
-
+        fragments = self.fragments
         sequences = [self.prepend]
+        self.streams = {}
+        self._reset_indices()
         if self.progress:
             self.bar.max = len(fragments) + 2
-        for index, fragment in enumerate(fragments):
-            take = 0
-            while True:
-                max_ocr = self.max_ocr.copy()
-                residues = self.residues.copy()
+        takes = [0] * len(fragments)
+        backtracks = 0
+        index = 0
+        while index < len(fragments):
+            if self._expired():
+                return self._record(sequences, index)
+            fragment = fragments[index]
+            start = time.perf_counter()
+            self.stream = self._stream(index)
+            self.budget.begin()
+            if index in self.library:
+                rna = self._draw_fragment(index)
+                prechecked = rna is not None
+            else:
+                rna = None
+                prechecked = False
+            screened = rna is None and self.sampler is not None
+            if screened:
+                rna = self._batch_fragment(fragment, sequences, index)
+            elif rna is None and self.forward_check:
+                rna = self._forward_fragment(fragment, sequences[-1])
+            elif rna is None:
                 rna = self._compute_fragment(fragment)
-                if index >= 0:
-                    if self._check_fragment(rna, sequences, index):
-                        break
-                    if take > self.max_repeat_attempts:
-                        return False
+            if self.stats:
+                self.stats.time('compute_fragment', start)
+            if rna is not None and (screened or self._check_fragment(rna, sequences, index, prechecked=prechecked)):
+                self.budget.commit()
+                sequences.append(rna)
+                self._add_fragment(rna)
+                index += 1
+                if self.progress:
+                    self.bar.next()
+                continue
+            if takes[index] > self.max_repeat_attempts:
+                self.budget.rollback()
+                if self.handicap_schedule == 'adaptive' and self._relax_bottlenecks(fragment):
+                    takes[index] = 0
+                    continue
+                # The restart engine gives up on the whole sequence, the backtrack
+                # engine drops the last few fragments a limited number of times
+                depth = min(self.backtrack_depth, index) if self.engine == 'backtrack' else 0
+                if self.stats:
+                    self.stats.give_up(index)
+                if depth == 0 or backtracks >= self.max_backtracks:
+                    return self._record(sequences, index)
+                backtracks += 1
+                takes[index] = 0
+                for _ in range(depth):
+                    index -= 1
+                    sequences.pop()
+                    self._remove_fragment()
+                    takes[index] = 0
+                self.rollbacks += depth
+                if self.progress:
+                    self.bar.goto(self.bar.index - depth)
+                continue
+            self.budget.rollback()
+            takes[index] += self.candidates if screened else 1
+
+        if not self._check_fragment(self.append, sequences, len(fragments), fixed=True):
+            return self._record(sequences, len(fragments))
+        else:
+            sequences.append(self.append)
+            self._add_fragment(self.append)
+            if self.progress:
+                self.bar.next()
+
+        return ''.join(sequences)
+
+    def _expired(self):
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def _record(self, sequences, index):
+        """
+        Keep a failed sequence attempt if it got further than the previous
+        ones, to be relaxed when the time budget runs out
+        Only its accepted fragments and codon budget are kept. Nothing is
+        done without a time budget
+
+        :param sequences: accepted fragments
+        :param index: index of the first fragment not accepted
+        :return: False
+        """
+
+        if self.time_budget is not None and (self.partial is None or index > self.partial[0]):
+            self.partial = index, list(sequences), list(self.max_ocr), list(self.residues), self.attempts
+        return False
+
+    def _relax(self):
+        """
+        Complete the failed sequence attempt that got the furthest
+        Every remaining fragment gets a few tries, and the try that violates
+        the fewest constraints is kept. Past the end of the time budget every
+        remaining fragment is drawn once
+
+        :return: RNA sequence and its violations, see _violations
+        """
+
+        index, sequences, max_ocr, residues, self.attempts = self.partial
+        sequences = list(sequences)
+        self.deadline = self.relax_deadline
+        self.max_ocr = list(max_ocr)
+        self.residues = list(residues)
+        self.budget = budget = Budget(self.max_ocr, self.residues, self.origins)
+        self.streams = {}
+        self._reset_indices()
+        for rna in sequences[1:]:
+            self._add_fragment(rna)
+        for index, fragment in enumerate(self.fragments[index:], index):
+            self.stream = self._stream(index)
+            best = None
+            for _ in range(self.relax_attempts):
+                budget.begin()
+                mark = len(budget.journal)
+                if self.forward_check:
+                    rna = self._forward_fragment(fragment, sequences[-1])
                 else:
+                    rna = self._compute_fragment(fragment)
+                violations = self._fragment_violations(rna, sequences)
+                if best is None or violations < best[0]:
+                    best = violations, rna, budget.journal[mark:]
+                budget.rollback()
+                if not violations or self._expired():
                     break
-                self.max_ocr = max_ocr
-                self.residues = residues
-                take += 1
+            _, rna, codons = best
+            budget.begin()
+            for codon in codons:
+                budget.draw(codon)
+            budget.commit()
             sequences.append(rna)
-            if self.progress:
-                self.bar.next()
+            self._add_fragment(rna)
+        sequences.append(self.append)
+        rna = ''.join(sequences)
+        return rna, self._violations(rna)
 
-        if not self._check_fragment(self.append, sequences, len(fragments) - 1):
-            return False
-        else:
-            sequences.append(self.append)
-            self.bar.next()
+    def _fragment_violations(self, rna, sequences):
+        """
+        Count the violations of a fragment against the accepted sequence,
+        per offending position as in _violations
 
-        return sum(sequences, Seq('', IUPAC.ambiguous_rna))
+        :param rna:
+        :param sequences: accepted fragments
+        :return:
+        """
+
+        count = 0
+        if self.check_repeats:
+            count += self.repeat_index.count(rna)
+        if self.check_invreps:
+            count += self.invrep_index.count(rna)
+        if self.check_stretch:
+            count += sum(len(match.group()) - self.max_stretch + 1
+                         for match in self.stretch.finditer(sequences[-1][-self.max_stretch:] + rna))
+        if self.check_gc:
+            count += self.gc_index.count(rna)
+        if self.avoid:
+            count += self.avoid_index.count(rna)
+        return count
+
+    def _relaxed(self):
+        """
+        Relax, report and return the attempt that got the furthest
+
+        :return:
+        """
+
+        if self.partial is None:
+            logging.error("No sequence could be completed within the time budget")
+            return ""
+        logging.info("Relaxing attempt %d, which reached fragment %d of %d",
+                     self.partial[4], self.partial[0], len(self.fragments))
+        rna, self.violations = self._relax()
+        logging.warning("Returning the best relaxed sequence, with violations: %s",
+                        ', '.join('%s=%s' % item for item in sorted(self.violations.items())))
+        return rna
+
+    @staticmethod
+    def _score(report):
+        """
+        Rank relaxed sequences by their violations, then by their codon
+        usage deviation
+
+        :param report: see _violations
+        :return:
+        """
+
+        return sum(count for name, count in report.items() if name != 'codon_deviation'), report['codon_deviation']
+
+    def _violations(self, rna):
+        """
+        Count the violations of every constraint in a complete sequence, and
+        its deviation from the codon usage
+        Violations are counted per offending position, so that longer repeats,
+        stretches and GC-rich regions weigh more. Avoided sites inside the
+        prepended or appended sequence are allowed
+
+        :param rna:
+        :return: dictionary of constraint to count, and the codon deviation
+        """
+
+        report = {}
+        if self.check_repeats:
+            k = self.min_repeat_len
+            kmers = [rna[i:i + k] for i in range(len(rna) - k + 1)]
+            report['repeats'] = len(kmers) - len(set(kmers))
+        if self.check_invreps:
+            k = self.min_invrep_len
+            complement = str.maketrans('ACGUacgu', 'UGCAugca')
+            seen = set()
+            report['invreps'] = 0
+            for i in range(len(rna) - k + 1):
+                kmer = rna[i:i + k]
+                if kmer.translate(complement)[::-1] in seen:
+                    report['invreps'] += 1
+                seen.add(kmer)
+        if self.check_stretch:
+            report['stretch'] = sum(len(match.group()) - self.max_stretch + 1
+                                    for match in self.stretch.finditer(rna))
+        if self.check_gc:
+            counts = GCIndex(self.gc_window, self.max_gc, rna).counts
+            window = min(self.gc_window, len(rna))
+            report['gc'] = sum(1 for end in range(window, len(rna) + 1)
+                               if (counts[end] - counts[end - window]) * 100 >= self.max_gc * window)
+        if self.avoid:
+            sites = SiteIndex(self.avoid, self.avoid_reverse)
+            fixed = len(rna) - len(self.append)
+            report['avoid'] = sum(1 for end, length in enumerate(sites._walk(rna))
+                                  if length and end >= len(self.prepend) and end - length + 1 < fixed)
+
+        used = Counter(rna[k:k + 3] for k in range(len(self.prepend), len(rna) - len(self.append), 3))
+        totals = Counter(r for fragment in self.fragments for r in fragment)
+        deviation = 0
+        for r, residue in enumerate(self.alphabet):
+            for codon in self.codons[residue]:
+                deviation += abs(used[codon.rna] - float(codon.fraction) * totals[r])
+        report['codon_deviation'] = round(deviation, 2)
+        return report
+
+    def _stream(self, index):
+        """
+        Random stream of a fragment in the current attempt, derived from the
+        seed, the attempt and the fragment index
+        A fragment visited again after a backtrack continues its stream
+
+        :param index: fragment index
+        :return:
+        """
+
+        stream = self.streams.get(index)
+        if stream is None:
+            stream = self.streams[index] = random.Random('{}/{}/{}'.format(self.seed, self.attempts, index))
+        return stream
+
+    def _reset_indices(self):
+        """
+        Start the sequence indices over from the prepended sequence
+
+        :return:
+        """
+
+        pool = self.pool
+        self.repeat_index = KmerIndex(self.min_repeat_len, self.prepend,
+                                      shared=pool.get(self.min_repeat_len) if pool is not None else None)
+        self.invrep_index = KmerIndex(self.min_invrep_len, self.prepend, inverse=True,
+                                      shared=pool.get(self.min_invrep_len) if pool is not None else None)
+        self.gc_index = GCIndex(self.gc_window, self.max_gc, self.prepend)
+        self.avoid_index.reset(self.prepend)
+
+    def _add_fragment(self, rna):
+        """
+        Add an accepted fragment to the sequence indices
+
+        :param rna:
+        :return:
+        """
+
+        self.repeat_index.add(rna)
+        self.invrep_index.add(rna)
+        self.gc_index.add(rna)
+        self.avoid_index.add(rna)
+
+    def _remove_fragment(self):
+        """
+        Roll back the last accepted fragment and return its codons to the budget
+
+        :return:
+        """
+
+        self.repeat_index.pop()
+        self.invrep_index.pop()
+        self.gc_index.pop()
+        self.avoid_index.pop()
+        self.budget.revert()
+
+    def _draw_fragment(self, index):
+        """
+        Draw a repeat from the library whose codons fit in the budget
+
+        :param index: fragment index
+        :return: RNA sequence, None if no drawn variant fits
+        """
+
+        entries = self.library[index]
+        max_ocr = self.max_ocr
+        for _ in range(RepeatLibrary.draws):
+            rna = self.stream.choice(entries)
+            counts = self.library_counts.get(rna)
+            if counts is None:
+                counts = self.library_counts[rna] = RepeatLibrary.counts(self.codons.ids, rna)
+            if all(max_ocr[codon] >= count for codon, count in counts):
+                for codon, count in counts:
+                    self.budget.draw(codon, count)
+                return rna
+        return None
+
+    def _batch_fragment(self, sequence, sequences, index):
+        """
+        Draw a batch of candidates for a repeat and keep the first one that
+        passes the checks
+        Only the candidates that survive the batch screening of base
+        stretches and GC content are checked for repeats, inverted repeats
+        and sites to avoid
+
+        :param sequence: encoded residues
+        :param sequences: accepted fragments
+        :param index: fragment index
+        :return: RNA sequence, None if no candidate passes
+        """
+
+        sampler = self.sampler
+        ids = sampler.sample(sequence, sampler.stream(self.seed, self.attempts, index))
+        alive, bases = sampler.screen(ids, sequences[-1])
+        if self.stats:
+            for constraint, count in sampler.rejections.items():
+                self.stats.reject(constraint, index, count)
+        for k in alive.nonzero()[0]:
+            rna = sampler.decode(bases[k])
+            if self._check_fragment(rna, sequences, index, screened=True):
+                for codon in ids[k].tolist():
+                    self.budget.draw(codon)
+                return rna
+        return None
 
     def _compute_fragment(self, sequence):
         """
         Codon-optimize a single repeat
 
-        :param sequence:
+        :param sequence: encoded residues
         :return:
         """
 
-        rna = Seq('', alphabet=IUPAC.ambiguous_rna)
+        table = self.codons.table
+        variants = self.variants
+        max_ocr = self.max_ocr
+        residues = self.residues
+        journal = self.budget.journal.append
+        toss = self.stream.random
+        rna = bytearray(3 * len(sequence))
         k = 0
         for r in sequence:
-            if r not in IUPACData.protein_letters:
-                continue
-            self._recalculate_thresholds(r)
-            toss = random.randint(0, self.residues[r])
-            for k, t in enumerate(self.thresholds[r]):
-                if toss <= t:
+            threshold = int(toss() * (residues[r] + 1))
+            total = 0
+            for codon in variants[r]:
+                total += max_ocr[codon]
+                if threshold <= total:
                     break
-            codon = self.codons[r][k]
-            rna = rna + codon.rna
-            self.max_ocr[r][codon.rna] = self.max_ocr[r][codon.rna] - 1
-            self.residues[r] = self.residues[r] - 1
-        return rna
+            max_ocr[codon] -= 1
+            residues[r] -= 1
+            journal(codon)
+            rna[k:k + 3] = table[codon]
+            k += 3
+        return rna.decode()
+
+    def _forward_fragment(self, sequence, previous):
+        """
+        Codon-optimize a single repeat, skipping the codons that would
+        complete a base stretch or a site to avoid
+        The trailing bases of the previous fragment and the state of the site
+        automaton are carried through the fragment. Codons are drawn from the
+        budget as in _compute_fragment; when every codon of a residue is
+        masked or exhausted the draw falls back to the whole budget and the
+        fragment is left to the checks
+
+        :param sequence: encoded residues
+        :param previous: last accepted fragment
+        :return:
+        """
 
-    def _recalculate_thresholds(self, r):
+        table = self.codons.table
+        variants = self.variants
+        max_ocr = self.max_ocr
+        residues = self.residues
+        journal = self.budget.journal.append
+        toss = self.stream.random
+        stretch = self._stretch_step if self.check_stretch else None
+        avoid = self._avoid_step if self.avoid and self.avoid_index.sites else None
+        tail = previous[-self.max_stretch:]
+        last = tail[-1:]
+        run = len(tail) - len(tail.rstrip(last)) if last else 0
+        state = self.avoid_index.state
+        rna = bytearray(3 * len(sequence))
+        k = 0
+        for r in sequence:
+            allowed = []
+            budget = 0
+            for codon in variants[r]:
+                if max_ocr[codon] <= 0:
+                    continue
+                if stretch and not stretch(last, run, codon)[2]:
+                    continue
+                if avoid and not avoid(state, codon)[1]:
+                    continue
+                allowed.append(codon)
+                budget += max_ocr[codon]
+            if allowed:
+                threshold = toss() * budget
+                total = 0
+                for codon in allowed:
+                    total += max_ocr[codon]
+                    if threshold < total:
+                        break
+            else:
+                threshold = int(toss() * (residues[r] + 1))
+                total = 0
+                for codon in variants[r]:
+                    total += max_ocr[codon]
+                    if threshold <= total:
+                        break
+            max_ocr[codon] -= 1
+            residues[r] -= 1
+            journal(codon)
+            rna[k:k + 3] = table[codon]
+            k += 3
+            if stretch:
+                last, run, _ = stretch(last, run, codon)
+            if avoid:
+                state = avoid(state, codon)[0]
+        return rna.decode()
+
+    def _stretch_step(self, last, run, codon):
         """
-        Recalculate codon-usage thresholds
+        Extend the trailing base run with a codon
 
-        :param r:
-        :return:
+        :param last: last base
+        :param run: length of its run
+        :param codon: codon id
+        :return: the new last base and run, and False if the codon completes a stretch
         """
 
-        total = 0
-        self.thresholds[r] = []
-        for codon in self.max_ocr[r]:
-            total = total + self.max_ocr[r][codon]
-            self.thresholds[r].append(total)
+        key = (last, run, codon)
+        step = self.stretch_steps.get(key)
+        if step is None:
+            valid = True
+            for base in self.codons.table[codon].decode():
+                run = run + 1 if base == last else 1
+                last = base
+                if run >= self.max_stretch:
+                    valid = False
+                    run = self.max_stretch
+            step = self.stretch_steps[key] = (last, run, valid)
+        return step
+
+    def _avoid_step(self, state, codon):
+        """
+        Advance the site automaton over a codon
+
+        :param state: automaton state
+        :param codon: codon id
+        :return: the new state, and False if the codon completes a site
+        """
+
+        key = (state, codon)
+        step = self.avoid_steps.get(key)
+        if step is None:
+            delta = self.avoid_index.delta
+            longest = self.avoid_index.longest
+            valid = True
+            for base in self.codons.table[codon].decode():
+                state = delta[state].get(base, 0)
+                if longest[state]:
+                    valid = False
+            step = self.avoid_steps[key] = (state, valid)
+        return step
+
+
+class Racers:
+    """
+    Processes racing the attempts of a seed for Draco.race
+    The processes can be reused for many races, e.g. for the targets of a
+    batch in pool mode. They get a copy of the pool index when they start,
+    and every race sends them only the constructs added to the pool since
+    the previous one. Every process takes exactly one part of every race.
+    """
+
+    def __init__(self, jobs, pool=None):
+        """
+        :param jobs: number of processes
+        :param pool: pool index of the optimizers, see PoolIndex
+        """
+
+        self.jobs = jobs
+        self.pool = pool
+        self.known = len(pool) if pool is not None else 0
+        self.ceiling = multiprocessing.Value('l', 0)
+        self.processes = multiprocessing.Pool(jobs, initializer=_share,
+                                              initargs=(self.ceiling, multiprocessing.Barrier(jobs), pool))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def race(self, draco, seed):
+        """
+        Race the attempts of a seed
+
+        :param draco: optimizer, without its pool index
+        :param seed:
+        :return: the attempt, the optimized sequence, the statistics and the
+                 violations of every process, in order of completion
+        """
+
+        added = self.pool.constructs[self.known:] if self.pool is not None else []
+        self.known += len(added)
+        self.ceiling.value = draco.max_sequence_attempts + 1
+        return self.processes.imap_unordered(partial(_race, draco, seed, self.jobs, added), range(self.jobs))
+
+    def close(self):
+        self.processes.close()
+        self.processes.join()
+
+
+def _share(ceiling, barrier, pool):
+    """
+    Keep the shared lowest successful attempt, the barrier of the races and
+    the pool index in the worker process of Racers
+
+    :param ceiling:
+    :param barrier:
+    :param pool:
+    :return:
+    """
+    _shared['ceiling'] = ceiling
+    _shared['barrier'] = barrier
+    _shared['pool'] = pool
+
+
+def _race(draco, seed, jobs, added, job):
+    """
+    Worker process of Draco.race
+    The process waits for the others, so that every process runs one part
+    of the race and gets the constructs added to the pool
+
+    :param draco:
+    :param seed:
+    :param jobs: number of processes
+    :param added: constructs added to the pool since the previous race
+    :param job: index of the process
+    :return: the attempt, the optimized sequence, the statistics and the violations
+    """
+    ceiling = _shared['ceiling']
+    _shared['barrier'].wait()
+    pool = _shared['pool']
+    for sequence in added:
+        pool.add(sequence)
+    draco.pool = pool
+    sequence = draco.random(seed, job, jobs, ceiling)
+    if sequence and not draco.violations:
+        with ceiling.get_lock():
+            ceiling.value = min(ceiling.value, draco.attempts)
+    return draco.attempts, sequence, draco.stats, draco.violations
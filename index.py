@@ -0,0 +1,459 @@
+from collections import deque
+from itertools import product
+
+
+class KmerIndex:
+    """
+    Incrementally updated k-mer index of an accepted sequence
+    This class keeps a rolling 2-bit hash of every k-mer, so that candidate
+    fragments can be checked in time proportional to their own length.
+    An inverse index looks up the reverse complement of every new k-mer
+    instead, which detects inverted repeats and hairpins. The k-mers of
+    other constructs can be shared with the index, so that repeats between
+    constructs are detected as well.
+    """
+
+    codes = {'A': 0, 'C': 1, 'G': 2, 'U': 3, 'T': 3,
+             'a': 0, 'c': 1, 'g': 2, 'u': 3, 't': 3}
+
+    def __init__(self, k, sequence='', inverse=False, shared=None):
+        self.k = k
+        self.inverse = inverse
+        self.shared = shared
+        self.mask = (1 << (2 * k)) - 1
+        self.shift = 2 * (k - 1)
+        self.kmers = {}
+        self.tail = ''
+        self.history = []
+        if sequence:
+            self.add(sequence)
+
+    def __len__(self):
+        return len(self.kmers)
+
+    def _scan(self, fragment):
+        """
+        Yield the hashes of every k-mer ending in the fragment, including
+        the k-mers spanning the junction with the accepted sequence
+
+        :param fragment:
+        :return: pairs of forward and reverse complement hashes
+        """
+
+        k = self.k
+        mask = self.mask
+        shift = self.shift
+        inverse = self.inverse
+        codes = self.codes
+        code = 0
+        reverse = 0
+        length = 0
+        for base in self.tail + str(fragment):
+            value = codes.get(base)
+            if value is None:
+                code = 0
+                reverse = 0
+                length = 0
+                continue
+            code = ((code << 2) | value) & mask
+            if inverse:
+                reverse = (reverse >> 2) | ((3 - value) << shift)
+            length += 1
+            if length >= k:
+                yield code, reverse
+
+    def _repeats(self, fragment):
+        """
+        Yield whether every k-mer ending in the fragment repeats (or, for an
+        inverse index, inverts) a k-mer of the accepted sequence or of itself
+
+        :param fragment:
+        :return:
+        """
+
+        kmers = self.kmers
+        shared = self.shared or ()
+        seen = set()
+        for code, reverse in self._scan(fragment):
+            word = reverse if self.inverse else code
+            yield word in kmers or word in seen or word in shared
+            seen.add(code)
+
+    def check(self, fragment):
+        """
+        Check that the fragment does not repeat (or, for an inverse index,
+        invert) any k-mer of the accepted sequence or of itself
+
+        :param fragment:
+        :return: True if the fragment is repeat-free
+        """
+
+        return not any(self._repeats(fragment))
+
+    def count(self, fragment):
+        """
+        Count the k-mers of the fragment that repeat (or invert) a k-mer of
+        the accepted sequence or of itself
+
+        :param fragment:
+        :return:
+        """
+
+        return sum(self._repeats(fragment))
+
+    def add(self, fragment):
+        """
+        Append an accepted fragment to the index
+
+        :param fragment:
+        :return:
+        """
+
+        kmers = self.kmers
+        added = [code for code, _ in self._scan(fragment)]
+        for code in added:
+            kmers[code] = kmers.get(code, 0) + 1
+        self.history.append((added, self.tail))
+        sequence = self.tail + str(fragment)
+        self.tail = sequence[max(0, len(sequence) - self.k + 1):]
+
+    def pop(self):
+        """
+        Remove the last accepted fragment from the index
+
+        :return:
+        """
+
+        kmers = self.kmers
+        added, self.tail = self.history.pop()
+        for code in added:
+            kmers[code] -= 1
+            if not kmers[code]:
+                del kmers[code]
+
+
+class PoolIndex:
+    """
+    Shared k-mers of the constructs of a synthesis pool
+    The index keeps one set of k-mer hashes per length, which the k-mer
+    indices of every new construct look up, and grows by one construct at
+    a time in time proportional to its length. The constructs are kept, so
+    that a new length can be indexed at any time
+    """
+
+    def __init__(self):
+        self.kmers = {}
+        self.constructs = []
+
+    def __len__(self):
+        return len(self.constructs)
+
+    def get(self, k):
+        """
+        Get the k-mers of the pool for a length
+
+        :param k:
+        :return: set of k-mer hashes
+        """
+
+        if k not in self.kmers:
+            index = KmerIndex(k)
+            self.kmers[k] = {code for sequence in self.constructs for code, _ in index._scan(sequence)}
+        return self.kmers[k]
+
+    def add(self, sequence):
+        """
+        Add the k-mers of a construct to the pool
+
+        :param sequence:
+        :return:
+        """
+
+        for k, kmers in self.kmers.items():
+            kmers.update(code for code, _ in KmerIndex(k)._scan(sequence))
+        self.constructs.append(str(sequence))
+
+
+class GCIndex:
+    """
+    Cumulative G/C counts of an accepted sequence
+    Every window of the construct is checked once, when the fragment it
+    ends in is proposed, with constant work per window
+    """
+
+    bases = frozenset('GCSgcs')
+
+    def __init__(self, window, max_gc, sequence=''):
+        self.window = window
+        self.max_gc = max_gc
+        self.counts = [0]
+        self.history = []
+        if sequence:
+            self.add(sequence)
+
+    def __len__(self):
+        return len(self.counts) - 1
+
+    def _cumulate(self, fragment):
+        """
+        Cumulative G/C counts of the fragment, continuing the accepted sequence
+
+        :param fragment:
+        :return:
+        """
+
+        bases = self.bases
+        count = self.counts[-1]
+        counts = []
+        for base in str(fragment):
+            if base in bases:
+                count += 1
+            counts.append(count)
+        return counts
+
+    def _windows(self, fragment):
+        """
+        Yield whether every window ending in the fragment reaches the max GC
+        content
+        A construct shorter than the window is a single window
+
+        :param fragment:
+        :return:
+        """
+
+        counts = self.counts
+        offset = len(counts)
+        extra = self._cumulate(fragment)
+        total = offset - 1 + len(extra)
+        if not extra:
+            return
+        if total < self.window:
+            yield extra[-1] * 100 >= self.max_gc * total
+            return
+        limit = self.max_gc * self.window
+        for end in range(max(self.window, offset), total + 1):
+            start = end - self.window
+            yield (extra[end - offset] - (counts[start] if start < offset else extra[start - offset])) * 100 >= limit
+
+    def check(self, fragment):
+        """
+        Check the GC content of every window ending in the fragment
+        A construct shorter than the window is checked as a whole
+
+        :param fragment:
+        :return: True if no window reaches the max GC content
+        """
+
+        return not any(self._windows(fragment))
+
+    def count(self, fragment):
+        """
+        Count the windows ending in the fragment that reach the max GC
+        content, see check
+
+        :param fragment:
+        :return:
+        """
+
+        return sum(self._windows(fragment))
+
+    def add(self, fragment):
+        """
+        Append an accepted fragment to the index
+
+        :param fragment:
+        :return:
+        """
+
+        self.history.append(len(self.counts))
+        self.counts.extend(self._cumulate(fragment))
+
+    def pop(self):
+        """
+        Remove the last accepted fragment from the index
+
+        :return:
+        """
+
+        del self.counts[self.history.pop():]
+
+
+class SiteIndex:
+    """
+    Aho-Corasick automaton of the sites to avoid
+    The automaton is compiled once and its state is carried over from the
+    accepted sequence, so a candidate fragment is scanned exactly once and
+    sites spanning the junction are still found
+    """
+
+    alphabet = 'ACGU'
+
+    def __init__(self, sites, reverse=False, sequence=''):
+        self.sites = self._expand(sites, reverse)
+        self.max_len = max((len(site) for site in self.sites), default=0)
+        self.delta = [{}]
+        self.longest = [0]
+        self.state = 0
+        self.history = []
+        self._compile(self.sites)
+        if sequence:
+            self.add(sequence)
+
+    def __len__(self):
+        return len(self.sites)
+
+    @staticmethod
+    def _expand(sites, reverse):
+        """
+        Expand IUPAC ambiguity codes and transcribe the sites to RNA
+
+        :param sites:
+        :param reverse: include the reverse complement of every site
+        :return:
+        """
+
+        if not sites:
+            return []
+        from Bio.Data import IUPACData
+        values = IUPACData.ambiguous_dna_values
+        complement = IUPACData.ambiguous_dna_complement
+        expanded = set()
+        for site in sites:
+            site = str(site).upper().replace('U', 'T')
+            variants = [site]
+            if reverse:
+                variants.append(''.join(complement[base] for base in reversed(site)))
+            for variant in variants:
+                for word in product(*[values[base] for base in variant]):
+                    expanded.add(''.join(word).replace('T', 'U'))
+        return sorted(expanded)
+
+    def _compile(self, sites):
+        """
+        Build the trie of the sites and turn it into a complete automaton
+
+        :param sites:
+        :return:
+        """
+
+        goto = [{}]
+        longest = [0]
+        for site in sites:
+            state = 0
+            for base in site:
+                if base not in goto[state]:
+                    goto[state][base] = len(goto)
+                    goto.append({})
+                    longest.append(0)
+                state = goto[state][base]
+            longest[state] = max(longest[state], len(site))
+
+        fail = [0] * len(goto)
+        delta = [{} for _ in goto]
+        queue = deque()
+        for base in self.alphabet:
+            state = goto[0].get(base, 0)
+            delta[0][base] = state
+            if state:
+                queue.append(state)
+        while queue:
+            state = queue.popleft()
+            longest[state] = max(longest[state], longest[fail[state]])
+            for base in self.alphabet:
+                if base in goto[state]:
+                    child = goto[state][base]
+                    fail[child] = delta[fail[state]][base]
+                    delta[state][base] = child
+                    queue.append(child)
+                else:
+                    delta[state][base] = delta[fail[state]][base]
+
+        self.delta = delta
+        self.longest = longest
+
+    def reset(self, sequence=''):
+        """
+        Restart the automaton from an empty (or the given) sequence
+
+        :param sequence:
+        :return:
+        """
+
+        self.state = 0
+        self.history = []
+        if sequence:
+            self.add(sequence)
+
+    def _walk(self, fragment):
+        """
+        Yield the length of the longest site ending at every base of the fragment
+
+        :param fragment:
+        :return:
+        """
+
+        delta = self.delta
+        longest = self.longest
+        state = self.state
+        for base in str(fragment):
+            state = delta[state].get(base, 0)
+            yield longest[state]
+
+    def check(self, fragment, fixed=False):
+        """
+        Check that no site ends in the fragment
+        Sites contained in a fixed fragment are allowed, only the sites
+        crossing the junction with the accepted sequence are reported
+
+        :param fragment:
+        :param fixed:
+        :return: True if the fragment is site-free
+        """
+
+        if not self.sites:
+            return True
+        for position, length in enumerate(self._walk(fragment)):
+            if fixed:
+                if length > position + 1:
+                    return False
+                if position + 1 >= self.max_len:
+                    break
+            elif length:
+                return False
+        return True
+
+    def count(self, fragment):
+        """
+        Count the sites ending in the fragment
+
+        :param fragment:
+        :return:
+        """
+
+        if not self.sites:
+            return 0
+        return sum(1 for length in self._walk(fragment) if length)
+
+    def add(self, fragment):
+        """
+        Advance the automaton over an accepted fragment
+
+        :param fragment:
+        :return:
+        """
+
+        delta = self.delta
+        state = self.state
+        self.history.append(state)
+        for base in str(fragment):
+            state = delta[state].get(base, 0)
+        self.state = state
+
+    def pop(self):
+        """
+        Rewind the automaton to before the last accepted fragment
+
+        :return:
+        """
+
+        self.state = self.history.pop()
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+import random
+from collections import Counter
+from index import KmerIndex, GCIndex, SiteIndex
+from tale import TALrepeat
+
+
+class RepeatLibrary:
+    """
+    On-disk library of codon variants of the TALE repeat modules
+    Apart from the RVD every repeat has the same protein sequence, so the
+    library keeps a pool of variants for each RVD, both as an inner and as
+    the last repeat. Every variant passes the repeat, inverted repeat,
+    stretch, GC and avoid checks on its own, which leaves only the junction
+    and cross-repeat constraints to be checked at design time.
+    Pools are keyed by the codon usage table, the constraints and the size
+    they were generated for, and are generated on first use.
+    """
+
+    size = 1000
+    max_attempts = 20
+    draws = 20
+    nucleotides = 'ACGTN'
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = self.size if size is None else size
+        self.pools = {}
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.pools = json.load(handle)
+
+    def key(self, draco):
+        """
+        Hash the codon table, the constraints checked inside a repeat and the
+        size of the pools
+
+        :param draco:
+        :return: hex digest
+        """
+
+        constraints = {
+            'codons': [(codon.rna, codon.protein, str(codon.fraction))
+                       for codon in draco.codons.codons.values()],
+            'avoid': sorted(str(word).upper() for word in draco.avoid or []),
+            'avoid_reverse': draco.avoid_reverse,
+            'check_repeats': draco.check_repeats,
+            'min_repeat_len': draco.min_repeat_len,
+            'check_invreps': draco.check_invreps,
+            'min_invrep_len': draco.min_invrep_len,
+            'check_stretch': draco.check_stretch,
+            'max_stretch': draco.max_stretch,
+            'check_gc': draco.check_gc,
+            'max_gc': draco.max_gc,
+            'gc_window': draco.gc_window,
+            'size': self.size,
+        }
+        return hashlib.sha256(json.dumps(constraints, sort_keys=True).encode()).hexdigest()
+
+    def variants(self, draco):
+        """
+        Get the repeat pools matching the constraints of an optimizer,
+        generating and storing them if needed
+
+        :param draco:
+        :return: dictionary of protein sequence to RNA variants
+        """
+
+        key = self.key(draco)
+        if key not in self.pools:
+            logging.info("Generating repeat library (%d variants per repeat)", self.size)
+            self.pools[key] = self._generate(draco, random.Random(key))
+            self.save()
+        return self.pools[key]
+
+    def _generate(self, draco, generator):
+        """
+        Sample codon variants of every repeat module
+
+        :param draco:
+        :param generator: random number generator
+        :return: dictionary of protein sequence to RNA variants
+        """
+
+        avoid = SiteIndex(draco.avoid, draco.avoid_reverse)
+        pools = {}
+        for nucleotide in self.nucleotides:
+            for last in (False, True):
+                protein = TALrepeat(nucleotide, last).sequence()
+                choices = [(draco.codons[r], [float(codon.fraction) for codon in draco.codons[r]])
+                           for r in protein]
+                variants = set()
+                for _ in range(self.size * self.max_attempts):
+                    if len(variants) >= self.size:
+                        break
+                    rna = ''.join(generator.choices(codons, weights)[0].rna for codons, weights in choices)
+                    if rna not in variants and self._check(draco, avoid, rna):
+                        variants.add(rna)
+                if len(variants) < self.size:
+                    logging.warning("Only %d variants of %s pass the constraints", len(variants), protein)
+                pools[protein] = sorted(variants)
+        return pools
+
+    @staticmethod
+    def _check(draco, avoid, rna):
+        """
+        Check a repeat variant on its own
+
+        :param draco:
+        :param avoid: site index of the fragments to avoid
+        :param rna:
+        :return: True if the variant passes all the checks
+        """
+
+        if draco.check_stretch and draco.stretch.search(rna):
+            return False
+        if draco.check_repeats and not KmerIndex(draco.min_repeat_len).check(rna):
+            return False
+        if draco.check_invreps and not KmerIndex(draco.min_invrep_len, inverse=True).check(rna):
+            return False
+        if draco.check_gc and not GCIndex(draco.gc_window, draco.max_gc).check(rna):
+            return False
+        if draco.avoid:
+            avoid.reset()
+            if not avoid.check(rna):
+                return False
+        return True
+
+    def entries(self, draco):
+        """
+        Map the fragments of an optimizer to their library variants
+
+        :param draco:
+        :return: dictionary of fragment index to RNA variants
+        """
+
+        pools = self.variants(draco)
+        return {index: pools[protein] for index, protein in enumerate(draco.proteins) if pools.get(protein)}
+
+    @staticmethod
+    def counts(ids, rna):
+        """
+        Count the codons of a variant
+
+        :param ids: codon ids by RNA codon
+        :param rna:
+        :return: (codon id, count) pairs
+        """
+
+        return tuple(Counter(ids[rna[k:k + 3]] for k in range(0, len(rna), 3)).items())
+
+    def save(self):
+        """
+        Write the library atomically, so that concurrent processes never
+        read a partial file
+
+        :return:
+        """
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = self.path + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'w') as output:
+            json.dump(self.pools, output)
+        os.replace(temporary, self.path)
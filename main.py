@@ -1,65 +1,157 @@
 #!/usr/bin/env python3
 
 import argparse
+import importlib.util
+import json
 import logging
-import warnings
-from Bio import BiopythonWarning
-from Bio.Seq import Seq
-from Bio.Alphabet import IUPAC
-from tale import TALE
-from draco import Draco
-from codon import CodonUsage
-
-warnings.simplefilter('ignore', BiopythonWarning)
-
-parser = argparse.ArgumentParser(description='Direct Repeat Aware Codon Optimizer')
-parser.add_argument('sequence', help='TALE binding sequence (DNA)')
-parser.add_argument('--upstream', help='Protein sequence to include upstream of the repeats', default='', type=str)
-parser.add_argument('--downstream', help='Protein sequence to include downstream of the repeats', default='', type=str)
-parser.add_argument('--avoid', action='append', help='Avoid this fragment in the optimized sequence (can be specified multiple times)', type=str)
-parser.add_argument('--prepend', help='Prepend the optimized sequence with this DNA sequence (this fragment won\'t be optimized)', default='', type=str)
-parser.add_argument('--append', help='Append this DNA sequence to the optimized sequence (this fragment won\'t be optimized)', default='', type=str)
-parser.add_argument('--check-repeats', help='Check the optimized sequence for repeats', default=True, type=bool)
-parser.add_argument('--repeat-len', default=20, help='Max allowed length of a repeat', type=int)
-parser.add_argument('--check-inv-repeats', help='Check the optimized sequence for inverse repeats', default=True, type=bool)
-parser.add_argument('--inv-repeat-len', default=12, help='Max allowed length of an inverted repeat', type=int)
-parser.add_argument('--check-stretch', help='Check for base stretches', default=True, type=bool)
-parser.add_argument('--stretch-len', default=8, help='Max allowed length of a base stretch', type=int)
-parser.add_argument('--check-gc', help='Check GC content', default=True, type=bool)
-parser.add_argument('--max-gc', default=65, help='Max allowed GC content', type=int)
-parser.add_argument('--gc-window', default=200, help='GC calculation window', type=int)
-parser.add_argument('--repeat-attempts', default=100, help='Max attempts to optimize a repeat', type=int)
-parser.add_argument('--seq-attempts', default=1000, help='Max attempts to optimize the sequence', type=int)
-parser.add_argument('--handicap', default=1, help='Max codon handicap for the optimized sequence', type=int)
-parser.add_argument('--progress', help='Show progress indicator', action='store_true')
-parser.add_argument('--log', help='Logging level')
-parser.add_argument('--debug', help='Enable debug logging')
-args = parser.parse_args()
-
-upstream = 'DTGQLVKIAKRGGVTAMEAVHASRNALTGAPLN'
-downstream = 'SIVAQLSRPDPALAALTNDHLVALACLGGRPAM'
-
-if args.debug:
-    args.log = 'DEBUG'
-
-if args.log:
-    logging.basicConfig(level=args.log.upper())
-    logging.getLogger('BiopythonWarning').setLevel(logging.INFO)
-
-target = Seq(args.sequence, alphabet=IUPAC.ambiguous_dna)
-upstream = Seq(args.upstream, alphabet=IUPAC.protein)
-downstream = Seq(args.downstream, alphabet=IUPAC.protein)
-tale = TALE(target, upstream=upstream, downstream=downstream)
-
-codons = CodonUsage(CodonUsage.Dmel)
-draco = Draco(tale, codons, args.avoid, args.prepend, args.append,
-              args.check_repeats, args.repeat_len, args.repeat_len,
-              args.check_inv_repeats, args.inv_repeat_len, args.inv_repeat_len,
-              args.check_stretch, args.stretch_len,
-              args.check_gc, args.max_gc, args.gc_window,
-              args.repeat_attempts, args.seq_attempts,
-              args.handicap, args.progress)
-dna = draco.random()
-if dna:
-    dna = dna.back_transcribe()
-    print('\n' + str(dna))
+import sys
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Direct Repeat Aware Codon Optimizer')
+    parser.add_argument('sequence', nargs='?', help='TALE binding sequence (DNA)')
+    parser.add_argument('--batch', help='Optimize all the targets of a FASTA or TSV file (with name, sequence and optional upstream, downstream and avoid columns)', type=str)
+    parser.add_argument('--checkpoint', help='In batch mode, record the finished targets in this file, and skip them when the batch is run again', type=str)
+    parser.add_argument('--pool', help='In batch mode, also avoid repeats and inverted repeats between the targets, e.g. for pooled synthesis', action='store_true')
+    parser.add_argument('--codon-table', default='Dmel', help='Codon usage table: Dmel, the name of a table in the table directory, or a Kazusa or CoCoPUTs file', type=str)
+    parser.add_argument('--upstream', help='Protein sequence to include upstream of the repeats', default='', type=str)
+    parser.add_argument('--downstream', help='Protein sequence to include downstream of the repeats', default='', type=str)
+    parser.add_argument('--avoid', action='append', help='Avoid this fragment in the optimized sequence (can be specified multiple times, IUPAC codes allowed)', type=str)
+    parser.add_argument('--avoid-reverse', help='Also avoid the reverse complement of the --avoid fragments', action='store_true')
+    parser.add_argument('--prepend', help='Prepend the optimized sequence with this DNA sequence (this fragment won\'t be optimized)', default='', type=str)
+    parser.add_argument('--append', help='Append this DNA sequence to the optimized sequence (this fragment won\'t be optimized)', default='', type=str)
+    parser.add_argument('--check-repeats', help='Check the optimized sequence for repeats', default=True, type=bool)
+    parser.add_argument('--repeat-len', default=20, help='Max allowed length of a repeat', type=int)
+    parser.add_argument('--check-inv-repeats', help='Check the optimized sequence for inverse repeats', default=True, type=bool)
+    parser.add_argument('--inv-repeat-len', default=12, help='Max allowed length of an inverted repeat', type=int)
+    parser.add_argument('--check-stretch', help='Check for base stretches', default=True, type=bool)
+    parser.add_argument('--stretch-len', default=8, help='Max allowed length of a base stretch', type=int)
+    parser.add_argument('--check-gc', help='Check GC content', default=True, type=bool)
+    parser.add_argument('--max-gc', default=65, help='Max allowed GC content', type=int)
+    parser.add_argument('--gc-window', default=200, help='GC calculation window', type=int)
+    parser.add_argument('--repeat-attempts', default=100, help='Max attempts to optimize a repeat', type=int)
+    parser.add_argument('--seq-attempts', default=1000, help='Max attempts to optimize the sequence', type=int)
+    parser.add_argument('--handicap', default=1, help='Max codon handicap for the optimized sequence', type=int)
+    parser.add_argument('--handicap-schedule', default='adaptive', choices=['uniform', 'adaptive'], help='Raise the handicap of all the codons on a fixed schedule, or also early for the residues whose budget runs out', type=str)
+    parser.add_argument('--engine', default='restart', choices=['restart', 'backtrack'], help='Search engine to use when a repeat cannot be optimized', type=str)
+    parser.add_argument('--backtrack-depth', default=2, help='Max number of fragments to roll back with the backtrack engine', type=int)
+    parser.add_argument('--max-backtracks', default=3, help='Max number of roll backs per sequence attempt with the backtrack engine', type=int)
+    parser.add_argument('--no-forward-check', dest='forward_check', help='Do not skip the codons that would complete a base stretch or a site to avoid while sampling', action='store_false')
+    parser.add_argument('--candidates', default=1, help='Draw this many candidates per repeat at once and screen them with NumPy before the repeat checks', type=int)
+    parser.add_argument('--library', help='Draw the repeats from this library of prechecked codon variants, generated on first use', type=str)
+    parser.add_argument('--library-size', default=1000, help='Number of variants per repeat module in the library', type=int)
+    parser.add_argument('--time-budget', help='Stop at this deadline in seconds and return the best relaxed sequence found, with a violation report', type=float)
+    parser.add_argument('--jobs', default=1, help='Number of processes racing to optimize the sequence (or optimizing the targets in batch mode)', type=int)
+    parser.add_argument('--seed', help='Random seed, reported in the log to reproduce a result', type=int)
+    parser.add_argument('--no-cache', help='Do not look up or store designs in the design cache', action='store_true')
+    parser.add_argument('--cache-size', default=64, help='Max size of the design cache in MB', type=int)
+    parser.add_argument('--stats', choices=['json'], help='Report rejections per constraint and fragment, timings and handicap increases on stderr', type=str)
+    parser.add_argument('--progress', help='Show progress indicator', action='store_true')
+    parser.add_argument('--log', help='Logging level')
+    parser.add_argument('--debug', help='Enable debug logging')
+    return parser
+
+
+def build_options(args):
+    """
+    Draco keyword arguments of the parsed command line
+
+    :param args:
+    :return:
+    """
+
+    from library import RepeatLibrary
+    return dict(check_repeats=args.check_repeats, min_repeat_len=args.repeat_len, max_repeat_len=args.repeat_len,
+                check_invreps=args.check_inv_repeats, min_invrep_len=args.inv_repeat_len,
+                max_invrep_len=args.inv_repeat_len,
+                check_stretch=args.check_stretch, max_stretch=args.stretch_len,
+                check_gc=args.check_gc, max_gc=args.max_gc, gc_window=args.gc_window,
+                max_repeat_attempts=args.repeat_attempts, max_sequence_attempts=args.seq_attempts,
+                max_handicap=args.handicap, handicap_schedule=args.handicap_schedule, avoid_reverse=args.avoid_reverse,
+                forward_check=args.forward_check, candidates=args.candidates, time_budget=args.time_budget,
+                engine=args.engine, backtrack_depth=args.backtrack_depth, max_backtracks=args.max_backtracks,
+                library=RepeatLibrary(args.library, args.library_size) if args.library else None)
+
+
+def main():
+    if sys.argv[1:2] == ['audit']:
+        import audit
+        sys.exit(audit.main(sys.argv[2:]))
+    if sys.argv[1:2] == ['serve']:
+        import server
+        sys.exit(server.main(sys.argv[2:]))
+
+    parser = build_parser()
+    args = parser.parse_args()
+    if not args.sequence and not args.batch:
+        parser.error('either a sequence or --batch is required')
+    if args.candidates > 1 and importlib.util.find_spec('numpy') is None:
+        parser.error('--candidates requires NumPy')
+
+    upstream = 'DTGQLVKIAKRGGVTAMEAVHASRNALTGAPLN'
+    downstream = 'SIVAQLSRPDPALAALTNDHLVALACLGGRPAM'
+
+    if args.debug:
+        args.log = 'DEBUG'
+
+    if args.log:
+        logging.basicConfig(level=args.log.upper())
+        logging.getLogger('BiopythonWarning').setLevel(logging.INFO)
+
+    # Imported after parsing the arguments so that --help and usage errors stay fast
+    from tale import TALE
+    from draco import Draco
+    from codon import CodonUsage
+    from cache import DesignCache
+    import batch
+
+    try:
+        codons = CodonUsage.load(args.codon_table)
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+    cache_size = None if args.no_cache else args.cache_size * 1024 * 1024
+    options = build_options(args)
+
+    if args.batch:
+        targets = batch.read_targets(args.batch, args.upstream, args.downstream, args.avoid)
+        failed = 0
+        try:
+            results = batch.run(targets, codons, args.prepend, args.append, options, args.jobs, cache_size,
+                                args.pool, args.seed, args.checkpoint)
+        except ValueError as error:
+            parser.error(str(error))
+        for target, dna, seed in results:
+            if dna:
+                print('>' + target['name'] + ' seed=' + str(seed) + '\n' + dna, flush=True)
+            else:
+                failed += 1
+                print(target['name'] + '\tfailed', file=sys.stderr, flush=True)
+        sys.exit(1 if failed else 0)
+
+    tale = TALE(args.sequence, upstream=args.upstream, downstream=args.downstream)
+
+    draco = Draco(tale, codons, args.avoid, args.prepend, args.append, progress=args.progress,
+                  stats=bool(args.stats), **options)
+    cache = None if cache_size is None else DesignCache(max_size=cache_size)
+    key = DesignCache.key(draco)
+    cached = cache.get(key) if cache and args.seed is None else None
+    if cached:
+        logging.info("Using cached design with seed %d", cached[1])
+        dna = cached[0]
+    elif args.jobs > 1:
+        dna = draco.race(args.jobs, args.seed)
+    else:
+        dna = draco.random(args.seed)
+    if dna and cache and not cached and not draco.violations:
+        cache.put(key, dna, draco.seed)
+    violations = batch.audit(draco, dna) if dna and not draco.violations else None
+    if violations:
+        logging.warning("Audit found violations: %s", violations)
+    if args.stats == 'json':
+        print(json.dumps(draco.stats.to_dict() if draco.stats else {}, indent=2), file=sys.stderr)
+    if dna:
+        print('\n' + dna.replace('U', 'T'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,525 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import signal
+import stat
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+_worker = {}
+
+# Command line options that make no sense for a single request
+unsupported = ('batch', 'pool', 'jobs', 'progress', 'log', 'debug', 'cache_size')
+# Options turned off with a --no- flag
+negated = ('forward_check',)
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+           413: 'Payload Too Large', 422: 'Unprocessable Entity', 503: 'Service Unavailable',
+           504: 'Gateway Timeout'}
+
+# HTTP status of the outcomes of a design request
+statuses = {'ok': 200, 'relaxed': 200, 'failed': 422, 'error': 422, 'cancelled': 409, 'timeout': 504}
+
+
+def _initialize(cache_size):
+    """
+    Load the built-in codon table and open the design cache once per worker
+    process
+
+    :param cache_size: max size of the design cache, None to disable it
+    :return:
+    """
+
+    from codon import CodonUsage
+    from cache import DesignCache
+    _worker['codons'] = {'Dmel': CodonUsage(CodonUsage.Dmel)}
+    _worker['cache'] = None if cache_size is None else DesignCache(max_size=cache_size)
+    _worker['libraries'] = {}
+
+
+def _codons(source):
+    """
+    Load a codon usage table once per worker process
+
+    :param source: file or organism name
+    :return:
+    """
+
+    from codon import CodonUsage
+    if source not in _worker['codons']:
+        _worker['codons'][source] = CodonUsage.load(source)
+    return _worker['codons'][source]
+
+
+def _library(path, size):
+    """
+    Open a repeat library once per worker process
+
+    :param path:
+    :param size: number of variants per repeat module
+    :return:
+    """
+
+    from library import RepeatLibrary
+    key = (path, size)
+    if key not in _worker['libraries']:
+        _worker['libraries'][key] = RepeatLibrary(path, size)
+    return _worker['libraries'][key]
+
+
+def _serve(design):
+    """
+    Optimize a design request in the worker process
+
+    :param design: see Server._prepare
+    :return: response dictionary
+    """
+
+    from tale import TALE
+    from draco import Draco
+    from cache import DesignCache
+
+    target = design['target']
+    try:
+        options = dict(design['options'])
+        if design['library']:
+            options['library'] = _library(*design['library'])
+        tale = TALE(target['sequence'], upstream=target['upstream'], downstream=target['downstream'])
+        draco = Draco(tale, _codons(design['codon_table']), target['avoid'], design['prepend'], design['append'],
+                      progress=False, stats=design['stats'], **options)
+        cache = _worker['cache'] if design['cache'] else None
+        key = DesignCache.key(draco)
+        cached = cache.get(key) if cache and design['seed'] is None else None
+        if cached:
+            return {'status': 'ok', 'sequence': cached[0].replace('U', 'T'), 'seed': cached[1], 'cached': True}
+        rna = draco.random(design['seed'])
+        if rna and cache and not draco.violations:
+            cache.put(key, rna, draco.seed)
+    except Exception as error:
+        logging.error("Failed to optimize %s: %r", target['name'], error)
+        return {'status': 'error', 'error': repr(error)}
+
+    expired = draco.deadline is not None and time.perf_counter() >= draco.deadline
+    if rna and not draco.violations:
+        status = 'ok'
+    elif rna and design['relaxed']:
+        status = 'relaxed'
+    else:
+        status = 'timeout' if expired else 'failed'
+    response = {'status': status, 'seed': draco.seed, 'cached': False, 'attempts': draco.attempts}
+    if status in ('ok', 'relaxed'):
+        response['sequence'] = rna.replace('U', 'T')
+    if status == 'relaxed':
+        response['violations'] = draco.violations
+    if draco.stats:
+        response['stats'] = draco.stats.to_dict()
+    return response
+
+
+class Job:
+    """
+    Design request waiting in the queue or running on the pool
+    """
+
+    def __init__(self, id, design, timeout):
+        self.id = id
+        self.design = design
+        self.timeout = timeout
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.cancelled = False
+        self.future = asyncio.get_running_loop().create_future()
+
+    def finish(self, response):
+        if not self.future.done():
+            self.future.set_result(response)
+
+
+class Counters:
+    """
+    Throughput and latency counters of the server
+    Latencies, from submission to response, and queue waits are kept for the
+    last requests only
+    """
+
+    window = 1000
+    interval = 60
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.received = 0
+        self.rejected = 0
+        self.outcomes = {}
+        self.latencies = deque(maxlen=self.window)
+        self.waits = deque(maxlen=self.window)
+        self.completions = deque()
+
+    def wait(self, job):
+        self.waits.append(job.started - job.submitted)
+
+    def finish(self, job, status):
+        now = time.perf_counter()
+        self.outcomes[status] = self.outcomes.get(status, 0) + 1
+        self.latencies.append(now - job.submitted)
+        self.completions.append(now)
+
+    @staticmethod
+    def _percentile(values, fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))], 4) if values else None
+
+    def to_dict(self, queued, running):
+        now = time.perf_counter()
+        while self.completions and self.completions[0] < now - self.interval:
+            self.completions.popleft()
+        uptime = now - self.started
+        latencies = sorted(self.latencies)
+        return {
+            'uptime': round(uptime, 3),
+            'queued': queued,
+            'running': running,
+            'received': self.received,
+            'rejected': self.rejected,
+            'outcomes': self.outcomes,
+            'throughput': {
+                'overall': round(sum(self.outcomes.values()) / uptime, 3) if uptime else 0,
+                'last_' + str(self.interval) + 's': round(len(self.completions) / min(uptime, self.interval), 3)
+                if uptime else 0,
+            },
+            'latency': {
+                'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+                'p50': self._percentile(latencies, 0.5),
+                'p95': self._percentile(latencies, 0.95),
+                'max': round(latencies[-1], 4) if latencies else None,
+            },
+            'queue_wait': {
+                'mean': round(sum(self.waits) / len(self.waits), 4) if self.waits else None,
+            },
+        }
+
+
+class Server:
+    """
+    Warm-process design server
+    Design requests, with the same parameters as the command line, are queued
+    with asyncio and run on a pool of worker processes that keep the codon
+    table, the design cache and the repeat libraries loaded. Every request has
+    a timeout, counted from its submission, at which the optimizer gives up.
+    A request with a time budget gets a relaxed sequence instead, if no valid
+    one is found within the budget or the timeout. Queued requests can be
+    cancelled; a running one can only be abandoned, its worker is released
+    at the deadline at the latest.
+
+    The server speaks a minimal HTTP/1.1 over a localhost TCP port or a Unix
+    socket:
+    POST /designs           submit a design request and wait for the result
+    DELETE /designs/<id>    cancel a request
+    GET /stats              throughput and latency counters
+    """
+
+    jobs = 1
+    timeout = 60
+    queue_size = 100
+    grace = 5
+    max_body = 1024 * 1024
+
+    def __init__(self, jobs=None, timeout=None, queue_size=None, cache_size=None):
+        from main import build_parser
+        self.jobs = self._default(jobs, self.jobs)
+        self.timeout = self._default(timeout, self.timeout)
+        self.queue_size = self._default(queue_size, self.queue_size)
+        self.cache_size = cache_size
+        self.parser = build_parser()
+        self.defaults = vars(self.parser.parse_args([]))
+        self.ids = itertools.count(1)
+        self.active = {}
+        self.running = 0
+        self.counters = Counters()
+        self.queue = None
+        self.executor = None
+
+    @staticmethod
+    def _default(value, default):
+        return default if value is None else value
+
+    def _arguments(self, request):
+        """
+        Parse a JSON design request with the command line parser
+        Keys are the destinations of the command line options, e.g.
+        {"sequence": "TTGACAATCC", "repeat_len": 24, "avoid": ["GGTCTC"]}
+
+        :param request:
+        :return: parsed arguments
+        """
+
+        argv = []
+        for key, value in request.items():
+            if key in ('id', 'timeout', 'name'):
+                continue
+            if key not in self.defaults or key in unsupported:
+                raise ValueError('Unsupported parameter: ' + key)
+            if key == 'sequence':
+                continue
+            flag = '--' + key.replace('_', '-')
+            if self.defaults[key] is False:
+                if value:
+                    argv.append(flag)
+            elif key in negated:
+                if not value:
+                    argv.append('--no-' + key.replace('_', '-'))
+            elif isinstance(value, list):
+                for item in value:
+                    argv += [flag, str(item)]
+            elif isinstance(value, bool):
+                argv += [flag, '1' if value else '']
+            elif value is not None:
+                argv += [flag, str(value)]
+        if not request.get('sequence'):
+            raise ValueError('A sequence is required')
+        argv += ['--', str(request['sequence'])]
+        errors = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(errors):
+                return self.parser.parse_args(argv)
+        except SystemExit:
+            raise ValueError(errors.getvalue().strip().split('\n')[-1])
+
+    def _prepare(self, request, timeout):
+        """
+        Turn a JSON design request into the arguments of a worker
+
+        :param request:
+        :param timeout: seconds left for the design
+        :return:
+        """
+
+        from main import build_options
+        args = self._arguments(request)
+        library = (args.library, args.library_size) if args.library else None
+        args.library = None
+        options = build_options(args)
+        options['timeout'] = timeout
+        return {
+            'target': {'name': str(request.get('name') or request.get('id') or 'design'),
+                       'sequence': args.sequence, 'upstream': args.upstream,
+                       'downstream': args.downstream, 'avoid': args.avoid},
+            'prepend': args.prepend,
+            'append': args.append,
+            'codon_table': args.codon_table,
+            'options': options,
+            'library': library,
+            'seed': args.seed,
+            'stats': bool(args.stats),
+            'cache': not args.no_cache and self.cache_size is not None,
+            'relaxed': args.time_budget is not None,
+        }
+
+    async def submit(self, request):
+        """
+        Queue a design request and wait for its response
+
+        :param request: JSON design request
+        :return: HTTP status and response dictionary
+        """
+
+        id = str(request.get('id') or next(self.ids))
+        if id in self.active:
+            return 409, {'id': id, 'error': 'A request with this id is already active'}
+        timeout = min(float(request.get('timeout') or self.timeout), self.timeout)
+        job = Job(id, self._prepare(request, timeout), timeout)
+        self.counters.received += 1
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counters.rejected += 1
+            return 503, {'id': id, 'error': 'The queue is full'}
+        self.active[id] = job
+        try:
+            response = await job.future
+        finally:
+            self.active.pop(id, None)
+        response['id'] = id
+        response['elapsed'] = round(time.perf_counter() - job.submitted, 4)
+        self.counters.finish(job, response['status'])
+        return statuses[response['status']], response
+
+    def cancel(self, id):
+        """
+        Cancel a queued request, or abandon a running one
+
+        :param id:
+        :return: HTTP status and response dictionary
+        """
+
+        job = self.active.get(id)
+        if job is None:
+            return 404, {'id': id, 'error': 'No active request with this id'}
+        job.cancelled = True
+        job.finish({'status': 'cancelled'})
+        return 200, {'id': id, 'status': 'cancelled', 'running': job.started is not None}
+
+    async def _dispatch(self):
+        """
+        Run the queued requests on the pool, one at a time per worker
+
+        :return:
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            if job.cancelled:
+                continue
+            job.started = time.perf_counter()
+            self.counters.wait(job)
+            remaining = job.timeout - (job.started - job.submitted)
+            if remaining <= 0:
+                job.finish({'status': 'timeout', 'error': 'Timed out in the queue'})
+                continue
+            design = dict(job.design, options=dict(job.design['options']))
+            design['options']['timeout'] = min(design['options']['timeout'], remaining)
+            self.running += 1
+            try:
+                response = await asyncio.wait_for(loop.run_in_executor(self.executor, _serve, design),
+                                                  remaining + self.grace)
+            except asyncio.TimeoutError:
+                response = {'status': 'timeout', 'error': 'The worker missed the deadline'}
+            except Exception as error:
+                logging.error("Worker failed on %s: %r", job.id, error)
+                response = {'status': 'error', 'error': repr(error)}
+            finally:
+                self.running -= 1
+            job.finish(response)
+
+    async def _handle(self, reader, writer):
+        """
+        Answer a single HTTP request
+
+        :param reader:
+        :param writer:
+        :return:
+        """
+
+        try:
+            method, path, body = await self._read(reader)
+            status, response = await self._route(method, path, body)
+        except ValueError as error:
+            status, response = 400, {'error': str(error)}
+        except Exception as error:
+            logging.exception("Failed to answer a request")
+            status, response = 422, {'error': repr(error)}
+        payload = json.dumps(response).encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, reasons[status], len(payload)).encode() + payload)
+        try:
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+    async def _read(self, reader):
+        line = (await reader.readline()).decode('latin-1').split()
+        if len(line) != 3:
+            raise ValueError('Malformed request line')
+        headers = {}
+        while True:
+            header = (await reader.readline()).decode('latin-1').strip()
+            if not header:
+                break
+            name, _, value = header.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > self.max_body:
+            raise ValueError('Request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return line[0].upper(), line[1], body
+
+    async def _route(self, method, path, body):
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if parts == ['stats']:
+            if method != 'GET':
+                return 405, {'error': 'Use GET'}
+            return 200, self.counters.to_dict(self.queue.qsize(), self.running)
+        if parts[:1] == ['designs'] and len(parts) == 1:
+            if method != 'POST':
+                return 405, {'error': 'Use POST'}
+            request = json.loads(body or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError('The request must be a JSON object')
+            return await self.submit(request)
+        if parts[:1] == ['designs'] and len(parts) == 2:
+            if method != 'DELETE':
+                return 405, {'error': 'Use DELETE'}
+            return self.cancel(parts[1])
+        return 404, {'error': 'Unknown path ' + path}
+
+    async def run(self, host='127.0.0.1', port=8150, socket=None):
+        """
+        Serve until interrupted
+
+        :param host:
+        :param port:
+        :param socket: path of a Unix socket to listen on instead of a TCP port
+        :return:
+        """
+
+        self.queue = asyncio.Queue(self.queue_size)
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=_initialize, initargs=(self.cache_size,))
+        # Start the workers now, so that the first requests find them warm
+        for future in [self.executor.submit(time.sleep, 0) for _ in range(self.jobs)]:
+            future.result()
+        dispatchers = [asyncio.ensure_future(self._dispatch()) for _ in range(self.jobs)]
+        if socket:
+            if os.path.exists(socket) and stat.S_ISSOCK(os.stat(socket).st_mode):
+                os.unlink(socket)
+            listener = await asyncio.start_unix_server(self._handle, socket)
+            logging.info("Listening on %s", socket)
+        else:
+            listener = await asyncio.start_server(self._handle, host, port)
+            logging.info("Listening on %s:%d", host, port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        try:
+            await stop.wait()
+        finally:
+            listener.close()
+            await listener.wait_closed()
+            for dispatcher in dispatchers:
+                dispatcher.cancel()
+            for job in list(self.active.values()):
+                job.finish({'status': 'cancelled'})
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            if socket and os.path.exists(socket):
+                os.unlink(socket)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='draco serve', description='Serve design requests from warm processes')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on', type=str)
+    parser.add_argument('--port', default=8150, help='TCP port to listen on', type=int)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of a TCP port', type=str)
+    parser.add_argument('--jobs', default=1, help='Number of worker processes', type=int)
+    parser.add_argument('--timeout', default=60, help='Max seconds per request, queue wait included (requests may ask for less)', type=float)
+    parser.add_argument('--queue-size', default=100, help='Max number of queued requests', type=int)
+    parser.add_argument('--no-cache', help='Do not look up or store designs in the design cache', action='store_true')
+    parser.add_argument('--cache-size', default=64, help='Max size of the design cache in MB', type=int)
+    parser.add_argument('--log', default='INFO', help='Logging level')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log.upper())
+    server = Server(jobs=args.jobs, timeout=args.timeout, queue_size=args.queue_size,
+                    cache_size=None if args.no_cache else args.cache_size * 1024 * 1024)
+    asyncio.run(server.run(args.host, args.port, args.socket))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
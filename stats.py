@@ -0,0 +1,102 @@
+import time
+
+
+class Stats:
+    """
+    Optimizer telemetry
+    This class counts the rejections of each constraint, overall and per
+    fragment index, times the checks and the optimization stages, and records
+    the handicap increases
+    """
+
+    def __init__(self):
+        self.attempts = 0
+        self.rollbacks = 0
+        self.rejections = {}
+        self.fragments = {}
+        self.stuck = {}
+        self.timers = {}
+        self.calls = {}
+        self.handicaps = []
+
+    def time(self, name, start):
+        """
+        Add the time elapsed since start to a timer
+
+        :param name:
+        :param start: time.perf_counter() value
+        :return:
+        """
+
+        self.timers[name] = self.timers.get(name, 0) + time.perf_counter() - start
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def check(self, checks, index):
+        """
+        Run all the checks of a fragment, timing them and counting their rejections
+
+        :param checks: (constraint, function, arguments) tuples
+        :param index: fragment index
+        :return: True if all the checks passed
+        """
+
+        valid = True
+        for constraint, check, arguments in checks:
+            start = time.perf_counter()
+            passed = check(*arguments)
+            self.time('check:' + constraint, start)
+            if not passed:
+                valid = False
+                self.reject(constraint, index)
+        return valid
+
+    def reject(self, constraint, index, count=1):
+        """
+        Count rejections
+
+        :param constraint:
+        :param index: fragment index
+        :param count: number of rejected candidates
+        :return:
+        """
+
+        self.rejections[constraint] = self.rejections.get(constraint, 0) + count
+        fragment = self.fragments.setdefault(index, {})
+        fragment[constraint] = fragment.get(constraint, 0) + count
+
+    def give_up(self, index):
+        """
+        Count a fragment that exhausted its attempts
+
+        :param index: fragment index
+        :return:
+        """
+
+        self.stuck[index] = self.stuck.get(index, 0) + 1
+
+    def handicap(self, attempt, handicap, residue=None):
+        """
+        Record a handicap increase
+
+        :param attempt: sequence attempt at which the handicap was raised
+        :param handicap: new handicap
+        :param residue: residue whose handicap was raised, None for all of them
+        :return:
+        """
+
+        increase = {'attempt': attempt, 'handicap': handicap}
+        if residue is not None:
+            increase['residue'] = residue
+        self.handicaps.append(increase)
+
+    def to_dict(self):
+        return {
+            'attempts': self.attempts,
+            'rollbacks': self.rollbacks,
+            'rejections': self.rejections,
+            'fragments': {str(index): counts for index, counts in sorted(self.fragments.items())},
+            'stuck': {str(index): count for index, count in sorted(self.stuck.items())},
+            'timers': {name: {'seconds': seconds, 'calls': self.calls[name]}
+                       for name, seconds in sorted(self.timers.items())},
+            'handicaps': self.handicaps,
+        }
@@ -1,6 +1,6 @@
-from Bio.Alphabet import IUPAC
-from Bio.Data import IUPACData
-from Bio.Seq import Seq
+# IUPAC ambiguous DNA letters, as in Bio.Data.IUPACData
+ambiguous_dna_letters = 'GATCRYWSMKHBVDN'
+
 
 class TALrepeat:
 
@@ -18,7 +18,7 @@ class TALrepeat:
             self.rvd = 'NG'
         elif nucleotide.upper() == 'C':
             self.rvd = 'HD'
-        elif nucleotide in IUPACData.ambiguous_dna_letters:
+        elif nucleotide in ambiguous_dna_letters:
             self.rvd = 'NS'
         else:
             self.rvd = None
@@ -31,21 +31,22 @@ class TALrepeat:
             return None
         else:
             if self.last:
-                return Seq(self.A + self.rvd + self.C, alphabet=IUPAC.protein)
+                return self.A + self.rvd + self.C
             else:
-                return Seq(self.A + self.rvd + self.B, alphabet=IUPAC.protein)
+                return self.A + self.rvd + self.B
 
     def template(self):
-        return Seq(self.A + 'XX' + self.B, alphabet=IUPAC.protein)
+        return self.A + 'XX' + self.B
 
 
 class TALE:
 
     def __init__(self, target, upstream=None, downstream=None):
-        self.target = target
+        self.target = str(target)
         self.repeats = []
-        self.upstream = upstream
-        self.downstream = downstream
+        self.upstream = str(upstream or '')
+        self.downstream = str(downstream or '')
+        target = self.target
         index = 0
         for n in target:
             index += 1
@@ -58,12 +59,7 @@ class TALE:
         return self.protein()
 
     def protein(self):
-        sequence = self.upstream
-        for r in self.repeats:
-            sequence += r.sequence()
-        sequence += self.downstream
-
-        return sequence
+        return self.upstream + ''.join(r.sequence() for r in self.repeats) + self.downstream
 
     def sequence(self):
         return self.protein()
@@ -0,0 +1,248 @@
+import os
+import random
+import unittest
+from tale import TALE
+from budget import Budget
+from draco import Draco
+from codon import CodonUsage
+from index import KmerIndex, GCIndex, SiteIndex
+from audit import suffix_array, lcp_array
+
+upstream = 'DTGQLVKIAKRGGVTAMEAVHASRNALTGAPLN'
+downstream = 'SIVAQLSRPDPALAALTNDHLVALACLGGRPAM'
+
+
+def optimizer(target='TACGTACGTAGC', avoid=None, **options):
+    tale = TALE(target, upstream=upstream, downstream=downstream)
+    return Draco(tale, CodonUsage(CodonUsage.Dmel), avoid, '', '', progress=False, **options)
+
+
+def reverse_complement(rna):
+    return rna.translate(str.maketrans('ACGU', 'UGCA'))[::-1]
+
+
+def random_rna(generator, length, bases='ACGU'):
+    return ''.join(generator.choice(bases) for _ in range(length))
+
+
+def brute_kmers(accepted, fragment, k, inverse=False):
+    """
+    Brute-force KmerIndex.check: every k-mer ending in the fragment, or its
+    reverse complement for an inverse index, must not occur before it
+    """
+    text = accepted + fragment
+    for i in range(max(len(accepted) - k + 1, 0), len(text) - k + 1):
+        word = text[i:i + k]
+        if inverse:
+            word = reverse_complement(word)
+        if word in {text[j:j + k] for j in range(i)}:
+            return False
+    return True
+
+
+def brute_gc(accepted, fragment, window, max_gc):
+    """
+    Brute-force GCIndex.check: no window ending in the fragment reaches the
+    max GC content, and a construct shorter than the window is checked whole
+    """
+    text = accepted + fragment
+    gc = lambda sequence: sum(base in 'GC' for base in sequence)
+    if len(text) < window:
+        return gc(text) * 100 < max_gc * len(text) if text else True
+    return all(gc(text[end - window:end]) * 100 < max_gc * window
+               for end in range(max(window, len(accepted) + 1), len(text) + 1))
+
+
+def brute_sites(sites, accepted, fragment, fixed=False):
+    """
+    Brute-force SiteIndex.check: no site ends in the fragment, or for a fixed
+    fragment no site starts before it
+    """
+    text = accepted + fragment
+    for site in sites:
+        for start in range(len(text) - len(site) + 1):
+            end = start + len(site)
+            if text[start:end] == site and end > len(accepted) and not (fixed and start >= len(accepted)):
+                return False
+    return True
+
+
+class TestDraco(unittest.TestCase):
+
+    def test_stretch_across_junction(self):
+        draco = optimizer(check_repeats=False, check_invreps=False, check_gc=False)
+        sequences = ['GCUGCU', 'GCUAAAAA']
+        self.assertFalse(draco._check_fragment('AAAGCU', sequences, 1))
+        self.assertTrue(draco._check_fragment('GCUAAA', sequences, 1))
+
+    def test_stretch_before_previous_fragment(self):
+        draco = optimizer(check_repeats=False, check_invreps=False, check_gc=False)
+        sequences = ['GCUAAAAA', 'GCUGCU']
+        self.assertTrue(draco._check_fragment('AAAGCU', sequences, 1))
+
+    def test_race_matches_serial(self):
+        # Needs a few attempts and raises residue handicaps with the default adaptive schedule
+        options = dict(target='TCGAGCATTAACGTTTCCGG', avoid=['GGTCTC', 'CGTCTC', 'GAAGAC', 'GCTCTTC'],
+                       min_repeat_len=16, max_repeat_len=16)
+        serial = optimizer(**options)
+        rna = serial.random(3)
+        self.assertTrue(rna)
+        self.assertGreater(serial.attempts, 1)
+        for jobs in (2, 3):
+            raced = optimizer(**options)
+            self.assertEqual(raced.race(jobs, 3), rna)
+            self.assertEqual(raced.attempts, serial.attempts)
+
+    def test_budget_journal(self):
+        generator = random.Random(6)
+        origins = [0, 0, 1, 1, 1, 2]
+        budget = Budget([3, 2, 4, 1, 0, 5], [5, 5, 5], origins)
+        initial = list(budget.codons), list(budget.residues)
+        for _ in range(3):
+            budget.begin()
+            for _ in range(generator.randint(1, 6)):
+                budget.draw(generator.randrange(len(origins)), generator.randint(1, 2))
+            budget.commit()
+        committed = list(budget.codons), list(budget.residues), list(budget.journal)
+        budget.begin()
+        budget.draw(2, 3)
+        budget.draw(5)
+        budget.rollback()
+        self.assertEqual((budget.codons, budget.residues, budget.journal), committed)
+        for _ in range(3):
+            budget.revert()
+        self.assertEqual((budget.codons, budget.residues), initial)
+        self.assertEqual((budget.journal, budget.marks, budget.committed), ([], [], []))
+
+    def test_kmer_index(self):
+        generator = random.Random(1)
+        for inverse in (False, True):
+            for _ in range(200):
+                k = generator.randint(3, 6)
+                index = KmerIndex(k, inverse=inverse)
+                accepted = ''
+                for _ in range(generator.randint(0, 3)):
+                    fragment = random_rna(generator, generator.randint(1, 12))
+                    index.add(fragment)
+                    accepted += fragment
+                fragment = random_rna(generator, generator.randint(1, 12))
+                self.assertEqual(index.check(fragment), brute_kmers(accepted, fragment, k, inverse),
+                                 (k, inverse, accepted, fragment))
+
+    def test_kmer_index_junction(self):
+        # Only the k-mers spanning the junction repeat or invert the accepted sequence
+        index = KmerIndex(4, 'GGACGG')
+        self.assertFalse(index.check('AC'))
+        self.assertTrue(index.check('UU'))
+        index = KmerIndex(4, 'AAGGCC', inverse=True)
+        self.assertFalse(index.check('UU'))
+        self.assertTrue(index.check('AA'))
+
+    def test_kmer_index_palindromes(self):
+        # A palindromic k-mer is its own reverse complement, it only inverts a later occurrence
+        index = KmerIndex(4, inverse=True)
+        self.assertTrue(index.check('ACGU'))
+        self.assertFalse(index.check('ACGUUACGU'))
+        index.add('ACGU')
+        self.assertFalse(index.check('ACGU'))
+
+    def test_kmer_index_pop(self):
+        generator = random.Random(2)
+        for inverse in (False, True):
+            index = KmerIndex(5, random_rna(generator, 20), inverse=inverse)
+            kmers, tail = dict(index.kmers), index.tail
+            index.add(random_rna(generator, 15))
+            index.add(random_rna(generator, 3))
+            index.pop()
+            index.pop()
+            self.assertEqual((index.kmers, index.tail), (kmers, tail))
+
+    def test_gc_index(self):
+        generator = random.Random(3)
+        for _ in range(500):
+            window = generator.randint(1, 20)
+            max_gc = generator.choice([40, 50, 65, 80])
+            index = GCIndex(window, max_gc)
+            accepted = ''
+            for _ in range(generator.randint(0, 3)):
+                fragment = random_rna(generator, generator.randint(1, 10))
+                index.add(fragment)
+                accepted += fragment
+            fragment = random_rna(generator, generator.randint(1, 10))
+            self.assertEqual(index.check(fragment), brute_gc(accepted, fragment, window, max_gc),
+                             (window, max_gc, accepted, fragment))
+
+    def test_gc_index_junction(self):
+        # The only GC-rich window spans the junction
+        index = GCIndex(4, 75, 'AAGG')
+        self.assertFalse(index.check('GCAA'))
+        self.assertTrue(index.check('AUAA'))
+
+    def test_gc_index_short_construct(self):
+        index = GCIndex(10, 50, 'GA')
+        self.assertTrue(index.check('A'))
+        self.assertFalse(index.check('G'))
+
+    def test_gc_index_pop(self):
+        generator = random.Random(4)
+        index = GCIndex(8, 65, random_rna(generator, 12))
+        counts = list(index.counts)
+        index.add(random_rna(generator, 9))
+        index.add(random_rna(generator, 2))
+        index.pop()
+        index.pop()
+        self.assertEqual(index.counts, counts)
+        fragment = random_rna(generator, 6)
+        self.assertEqual(index.check(fragment), brute_gc(random_rna(random.Random(4), 12), fragment, 8, 65))
+
+    def test_site_index_expansion(self):
+        self.assertEqual(SiteIndex(['GGNCC']).sites, ['GGACC', 'GGCCC', 'GGGCC', 'GGUCC'])
+        self.assertEqual(SiteIndex(['GAAGAC'], reverse=True).sites, ['GAAGAC', 'GUCUUC'])
+        self.assertEqual(SiteIndex(['RGATCY'], reverse=True).sites, ['AGAUCC', 'AGAUCU', 'GGAUCC', 'GGAUCU'])
+
+    def test_site_index(self):
+        generator = random.Random(5)
+        for _ in range(300):
+            raw = [random_rna(generator, generator.randint(2, 4), 'ACGTNRY').replace('U', 'T')
+                   for _ in range(generator.randint(1, 3))]
+            reverse = generator.random() < 0.5
+            fixed = generator.random() < 0.5
+            index = SiteIndex(raw, reverse)
+            accepted = ''
+            for _ in range(generator.randint(0, 3)):
+                fragment = random_rna(generator, generator.randint(1, 8))
+                index.add(fragment)
+                accepted += fragment
+            fragment = random_rna(generator, generator.randint(1, 8))
+            self.assertEqual(index.check(fragment, fixed), brute_sites(index.sites, accepted, fragment, fixed),
+                             (raw, reverse, fixed, accepted, fragment))
+
+    def test_site_index_junction(self):
+        index = SiteIndex(['GGTCTC'], sequence='AAGGUC')
+        self.assertFalse(index.check('UCAA'))
+        self.assertTrue(index.check('UGAA'))
+
+    def test_site_index_fixed(self):
+        # Sites inside a fixed fragment are allowed, the ones crossing its junction are not
+        index = SiteIndex(['GGTCTC'], reverse=True, sequence='AAAA')
+        self.assertFalse(index.check('AAGGUCUCAA'))
+        self.assertTrue(index.check('AAGGUCUCAA', fixed=True))
+        self.assertTrue(index.check('AAGAGACCAA', fixed=True))
+        index.add('GGUC')
+        self.assertFalse(index.check('UCAAAA', fixed=True))
+        index.pop()
+        self.assertTrue(index.check('UCAAAA', fixed=True))
+
+    def test_suffix_array(self):
+        # Short texts over a wide alphabet, whose character codes exceed the text length
+        generator = random.Random(7)
+        for _ in range(500):
+            text = random_rna(generator, generator.randint(1, 40), 'ACGT#$')
+            sa = suffix_array(text)
+            self.assertEqual(sa, sorted(range(len(text)), key=lambda i: text[i:]), text)
+            common = [0] + [len(os.path.commonprefix([text[sa[r - 1]:], text[sa[r]:]])) for r in range(1, len(sa))]
+            self.assertEqual(lcp_array(text, sa), common, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
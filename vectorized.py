@@ -0,0 +1,166 @@
+import numpy
+
+# Base codes of the candidate arrays, other characters of the accepted
+# sequence get codes of their own so that they never extend a run
+codes = {'A': 0, 'C': 1, 'G': 2, 'U': 3}
+letters = numpy.frombuffer(b'ACGU', dtype=numpy.uint8)
+gc_bases = numpy.array([0, 1, 1, 0], dtype=numpy.int64)
+
+
+class CandidateSampler:
+    """
+    Batched sampling and screening of candidate fragments
+    This class draws a batch of candidates for a fragment at once, as an
+    array of encoded bases, and rejects the candidates that contain or
+    complete a base stretch, or reach the max GC content in a window, with a
+    few array passes over the whole batch. The survivors are left to the
+    repeat, inverted repeat and avoid checks, one at a time.
+    The candidates of a batch are independent of each other, each one is
+    drawn from the budget left at the start of the fragment.
+    """
+
+    def __init__(self, draco, count):
+        """
+        :param draco:
+        :param count: number of candidates per batch
+        """
+
+        self.draco = draco
+        self.count = count
+        self.attempt = None
+        self.streams = {}
+        self.bases = numpy.array([[codes[base] for base in codon.decode()] for codon in draco.codons.table],
+                                 dtype=numpy.uint8)
+        self.variants = [numpy.array(codons, dtype=numpy.int64) for codons in draco.variants]
+        self.rejections = {}
+
+    def stream(self, seed, attempt, index):
+        """
+        Random generator of a fragment in an attempt, derived from the seed,
+        the attempt and the fragment index
+
+        :param seed:
+        :param attempt:
+        :param index: fragment index
+        :return:
+        """
+
+        if attempt != self.attempt:
+            self.attempt = attempt
+            self.streams = {}
+        if index not in self.streams:
+            self.streams[index] = numpy.random.default_rng([seed, attempt, index])
+        return self.streams[index]
+
+    def sample(self, sequence, generator):
+        """
+        Draw a batch of candidates for a fragment
+        Every candidate depletes its own copy of the budget, one position at
+        a time for the whole batch. When every codon of a residue is
+        exhausted the first one is drawn, as in _compute_fragment
+
+        :param sequence: encoded residues
+        :param generator: random generator of the fragment
+        :return: codon ids of the candidates, one row each
+        """
+
+        count = self.count
+        budget = numpy.tile(numpy.maximum(numpy.array(self.draco.max_ocr, dtype=numpy.float64), 0), (count, 1))
+        rows = numpy.arange(count)
+        ids = numpy.empty((count, len(sequence)), dtype=numpy.int64)
+        for k, r in enumerate(sequence):
+            variants = self.variants[r]
+            cumulative = numpy.cumsum(budget[:, variants], axis=1)
+            draws = generator.random(count) * cumulative[:, -1]
+            choices = numpy.where(cumulative[:, -1] > 0, (cumulative <= draws[:, None]).sum(axis=1), 0)
+            codons = variants[choices]
+            ids[:, k] = codons
+            budget[rows, codons] = numpy.maximum(budget[rows, codons] - 1, 0)
+        return ids
+
+    def screen(self, ids, previous):
+        """
+        Reject the candidates that have a base stretch or a GC-rich window
+
+        :param ids: codon ids of the candidates
+        :param previous: last accepted fragment
+        :return: boolean mask of the surviving candidates, and their bases
+        """
+
+        draco = self.draco
+        count = len(ids)
+        bases = self.bases[ids].reshape(count, -1)
+        alive = numpy.ones(count, dtype=bool)
+        self.rejections = {}
+        if draco.check_stretch:
+            alive &= self._stretch(bases, previous)
+            self._reject('stretch', alive, count)
+        if draco.check_gc:
+            alive &= self._gc(bases)
+            self._reject('gc', alive, count)
+        return alive, bases
+
+    def _reject(self, constraint, alive, count):
+        rejected = count - int(alive.sum()) - sum(self.rejections.values())
+        if rejected:
+            self.rejections[constraint] = rejected
+
+    def _stretch(self, bases, previous):
+        """
+        Find the candidates without a base stretch, including the stretches
+        across the junction with the previous fragment
+
+        :param bases: encoded bases of the candidates
+        :param previous: last accepted fragment
+        :return: boolean mask
+        """
+
+        window = self.draco.max_stretch - 1
+        tail = numpy.array([codes.get(base, 16 + ord(base)) for base in previous[-self.draco.max_stretch:]],
+                           dtype=numpy.int64)
+        text = numpy.hstack((numpy.broadcast_to(tail, (len(bases), len(tail))), bases))
+        if window <= 0:
+            return numpy.zeros(len(bases), dtype=bool)
+        same = (text[:, 1:] == text[:, :-1]).astype(numpy.int64)
+        if same.shape[1] < window:
+            return numpy.ones(len(bases), dtype=bool)
+        runs = numpy.cumsum(numpy.hstack((numpy.zeros((len(bases), 1), dtype=numpy.int64), same)), axis=1)
+        return ~((runs[:, window:] - runs[:, :-window]) == window).any(axis=1)
+
+    def _gc(self, bases):
+        """
+        Find the candidates without a GC-rich window, with the semantics of
+        GCIndex.check
+
+        :param bases: encoded bases of the candidates
+        :return: boolean mask
+        """
+
+        index = self.draco.gc_index
+        counts = numpy.array(index.counts, dtype=numpy.int64)
+        offset = len(counts)
+        extra = counts[-1] + numpy.cumsum(gc_bases[bases], axis=1)
+        total = offset - 1 + bases.shape[1]
+        if total == 0:
+            return numpy.ones(len(bases), dtype=bool)
+        if total < index.window:
+            return extra[:, -1] * 100 < index.max_gc * total
+        ends = numpy.arange(max(index.window, offset), total + 1)
+        starts = ends - index.window
+        accepted = starts < offset
+        before = numpy.empty((len(bases), len(starts)), dtype=numpy.int64)
+        before[:, accepted] = counts[starts[accepted]]
+        before[:, ~accepted] = extra[:, starts[~accepted] - offset]
+        gc = extra[:, ends - offset] - before
+        return ~(gc * 100 >= index.max_gc * index.window).any(axis=1)
+
+    @staticmethod
+    def decode(bases):
+        """
+        Decode the bases of a candidate
+
+        :param bases: encoded bases
+        :return: RNA sequence
+        """
+
+        return letters[bases].tobytes().decode()